@@ -0,0 +1,121 @@
+import os
+import sys
+import time
+import platform
+import subprocess
+import paddle
+import paddle.optimizer as optim
+import numpy as np
+
+# forward : inference (eval, no grad), backward : training forward + backward,
+# train : forward + backward + Adam step
+MODES = ('forward', 'backward', 'train')
+# timed steps needed before p99 is reported
+P99_MIN_ITERS = 100
+
+
+def synchronize():
+    if paddle.device.is_compiled_with_cuda():
+        paddle.device.synchronize()
+
+
+def environment():
+    # what the timings depend on, stored next to them
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'paddle': paddle.__version__,
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'device': paddle.device.get_device(),
+        'cuda': paddle.device.is_compiled_with_cuda(),
+        'paddle_num_threads': paddle.get_flags('FLAGS_paddle_num_threads')['FLAGS_paddle_num_threads'],
+        'OMP_NUM_THREADS': os.environ.get('OMP_NUM_THREADS'),
+        'MKL_NUM_THREADS': os.environ.get('MKL_NUM_THREADS'),
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+
+def step_fn(network, mode, x):
+    # one timed step of the given mode
+    if mode == 'forward':
+        network.eval()
+
+        def step():
+            with paddle.no_grad():
+                network(x)
+        return step
+
+    network.train()
+    optimizer = optim.Adam(parameters=network.parameters()) if mode == 'train' else None
+
+    def step():
+        predict = network(x)
+        predict = predict if isinstance(predict, (list, tuple)) else [predict]
+        sum(p.mean() for p in predict).backward()
+        if optimizer is not None:
+            optimizer.step()
+        network.clear_gradients()
+    return step
+
+
+def benchmark_case(network, mode, batch_size, size, warmup=3, iters=P99_MIN_ITERS):
+    '''
+    latency percentiles (ms) and throughput (images / s) of iters steps of one
+    mode / batch size / input size, the warmup steps are not timed
+    '''
+    step = step_fn(network, mode, paddle.rand([batch_size, 3, size, size]))
+    for _ in range(warmup):
+        step()
+    synchronize()
+
+    latency = []
+    for _ in range(iters):
+        begin = time.perf_counter()
+        step()
+        synchronize()
+        latency.append((time.perf_counter() - begin) * 1000)
+
+    latency = np.array(latency)
+    result = {'p50_ms': float(np.percentile(latency, 50)), 'p95_ms': float(np.percentile(latency, 95)),
+              'mean_ms': float(latency.mean()), 'images_per_s': float(batch_size * 1000 / latency.mean()),
+              'iters': iters, 'warmup': warmup}
+    # with fewer steps p99 is just the slowest one
+    if iters >= P99_MIN_ITERS:
+        result['p99_ms'] = float(np.percentile(latency, 99))
+    return result
+
+
+def run(build, models, modes, batch_sizes, sizes, warmup=3, iters=P99_MIN_ITERS):
+    '''
+    every model x mode x batch size x input size, build(name) returns a fresh network.
+    cases that run out of memory are recorded with their error and skipped
+    '''
+    results = []
+    for name in models:
+        network = build(name)
+        for mode in modes:
+            for batch_size in batch_sizes:
+                for size in sizes:
+                    case = {'model': name, 'mode': mode, 'batch_size': batch_size, 'size': size}
+                    try:
+                        case.update(benchmark_case(network, mode, batch_size, size, warmup, iters))
+                    except (MemoryError, RuntimeError) as e:
+                        case['error'] = str(e).strip().splitlines()[-1]
+                    print(format_case(case))
+                    results.append(case)
+    return {'environment': environment(), 'results': results}
+
+
+def format_case(case):
+    name = '{model:<8} {mode:<9} batch {batch_size:<3} size {size:<5}'.format(**case)
+    if 'error' in case:
+        return '{} failed: {}'.format(name, case['error'])
+    p99 = '  p99 {:9.2f} ms'.format(case['p99_ms']) if 'p99_ms' in case else ''
+    return '{} p50 {p50_ms:9.2f} ms  p95 {p95_ms:9.2f} ms{}  {images_per_s:8.2f} images/s'.format(name, p99, **case)
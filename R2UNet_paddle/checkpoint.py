@@ -0,0 +1,85 @@
+import os
+import re
+import random
+import paddle
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+def to_host(state):
+    # copy of a (nested) state dict with every tensor copied to a numpy array, taken
+    # before the next optimizer step can change the tensors
+    if isinstance(state, paddle.Tensor):
+        return state.numpy()
+    if isinstance(state, dict):
+        return {k: to_host(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_host(v) for v in state)
+    return state
+
+
+def rng_state():
+    return {'python': random.getstate(), 'numpy': np.random.get_state(), 'paddle': paddle.get_rng_state()}
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    paddle.set_rng_state(state['paddle'])
+
+
+class AsyncCheckpointer:
+    '''
+    writes training state checkpoints from a background thread. save() takes a host
+    snapshot and returns, the file is written to a temporary name and renamed into
+    place, so a checkpoint on disk is always complete. only the keep newest
+    checkpoints are kept, keep <= 0 keeps all of them
+    '''
+    pattern = re.compile(r'^ckpt_(\d+)\.pdckpt$')
+
+    def __init__(self, directory, keep=3):
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+        # one writer thread, so the checkpoints land in order
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def save(self, state, step):
+        # a write still running when the next one is requested is waited for,
+        # so at most one snapshot is held in memory
+        self.wait()
+        snapshot = to_host(state)
+        self.pending = self.pool.submit(self.write, snapshot, step)
+
+    def write(self, snapshot, step):
+        path = os.path.join(self.directory, 'ckpt_{:08d}.pdckpt'.format(step))
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        paddle.save(snapshot, tmp_path)
+        os.replace(tmp_path, path)
+        if self.keep > 0:
+            for old in checkpoints(self.directory)[:-self.keep]:
+                os.remove(old)
+        return path
+
+    def wait(self):
+        # re-raises a failed write
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        self.wait()
+        self.pool.shutdown()
+
+
+def checkpoints(directory):
+    # complete checkpoints of directory, oldest first
+    if not os.path.isdir(directory):
+        return []
+    names = sorted(name for name in os.listdir(directory) if AsyncCheckpointer.pattern.match(name))
+    return [os.path.join(directory, name) for name in names]
+
+
+def load(path):
+    return paddle.load(path, return_numpy=True)
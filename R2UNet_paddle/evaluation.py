@@ -1,92 +1,145 @@
 import paddle
+import numpy as np
 
 # SR : Segmentation Result
 # GT : Ground Truth
 
-def get_accuracy(SR, GT, threshold=0.5):
-    SR = SR > threshold
-    GT = GT == paddle.max(GT)
-    corr = paddle.sum(SR == GT)
-    tensor_size = SR.shape[0] * SR.shape[1]* SR.shape[2] * SR.shape[3]
-    acc = float(corr) / float(tensor_size)
+def confusion_counts(SR, GT, mask=None, per_sample=False):
+    # SR, GT : boolean tensors, returns the TN, FN, FP, TP counts (per sample along
+    # the first axis if per_sample) in a single pass : every pixel gets the bin
+    # 2 * SR + GT, pixels outside the mask go to a fifth bin that is dropped
+    bins = SR.astype('int64') * 2 + GT.astype('int64')
+    if mask is not None:
+        bins = paddle.where(mask > 0.5, bins, paddle.full_like(bins, 4))
+    if not per_sample:
+        return paddle.bincount(bins.flatten(), minlength=5)[:4]
+
+    n = bins.shape[0]
+    bins = bins.reshape([n, -1]) + paddle.arange(n, dtype='int64').unsqueeze(1) * 5
+    return paddle.bincount(bins.flatten(), minlength=5 * n).reshape([n, 5])[:, :4]
+
+
+def metrics_from_counts(TN, FN, FP, TP):
+    # works on floats as well as on numpy arrays of per-sample counts
+    AC = (TP + TN) / (TP + TN + FP + FN + 1e-6)
+    SE = TP / (TP + FN + 1e-6)
+    SP = TN / (TN + FP + 1e-6)
+    PC = TP / (TP + FP + 1e-6)
+    F1 = 2 * SE * PC / (SE + PC + 1e-6)
+    JS = TP / (TP + FP + FN + 1e-6)
+    DC = 2 * TP / (2 * TP + FP + FN + 1e-6)
 
-    return acc
+    return {'AC': AC, 'SE': SE, 'SP': SP, 'PC': PC, 'F1': F1, 'JS': JS, 'DC': DC}
 
 
-def get_sensitivity(SR, GT, threshold=0.5):
-    # Sensitivity == Recall
+def compute_all(SR, GT, threshold=0.5, mask=None, per_sample=False):
+    # thresholds once and derives all seven metrics from one confusion count.
+    # GT in [0, 1] is binarized at 0.5 like in ConfusionMatrix, so images without
+    # vessels have no positives. with per_sample the metrics are numpy arrays over
+    # the batch axis, with mask only the pixels inside the mask (e.g. the FOV) are counted
     SR = SR > threshold
-    GT = GT == paddle.max(GT)
+    GT = GT > 0.5
 
-    # TP : True Positive
-    # FN : False Negative
-    TP = paddle.sum((SR == 1) & (GT == 1))
-    FN = paddle.sum((SR == 0) & (GT == 1))
+    counts = confusion_counts(SR, GT, mask, per_sample).numpy().astype(np.float64)
 
-    SE = float(paddle.sum(TP)) / (float(paddle.sum(TP + FN)) + 1e-6)
+    if per_sample:
+        return metrics_from_counts(*counts.T)
+    return metrics_from_counts(*[float(c) for c in counts])
 
-    return SE
 
+def get_accuracy(SR, GT, threshold=0.5):
+    return compute_all(SR, GT, threshold)['AC']
 
-def get_specificity(SR, GT, threshold=0.5):
-    SR = SR > threshold
-    GT = GT == paddle.max(GT)
 
-    # TN : True Negative
-    # FP : False Positive
-    TN = paddle.sum((SR == 0) & (GT == 0))
-    FP = paddle.sum((SR == 1) & (GT == 0))
+def get_sensitivity(SR, GT, threshold=0.5):
+    # Sensitivity == Recall
+    return compute_all(SR, GT, threshold)['SE']
 
-    SP = float(paddle.sum(TN)) / (float(paddle.sum(TN + FP)) + 1e-6)
 
-    return SP
+def get_specificity(SR, GT, threshold=0.5):
+    return compute_all(SR, GT, threshold)['SP']
 
 
 def get_precision(SR, GT, threshold=0.5):
-    SR = SR > threshold
-    GT = GT == paddle.max(GT)
-
-    # TP : True Positive
-    # FP : False Positive
-    TP = paddle.sum((SR == 1) & (GT == 1))
-    FP = paddle.sum((SR == 1) & (GT == 0))
-
-    PC = float(paddle.sum(TP)) / (float(paddle.sum(TP + FP)) + 1e-6)
-
-    return PC
+    return compute_all(SR, GT, threshold)['PC']
 
 
 def get_F1(SR, GT, threshold=0.5):
-    # Sensitivity == Recall
-    SE = get_sensitivity(SR, GT, threshold=threshold)
-    PC = get_precision(SR, GT, threshold=threshold)
-
-    F1 = 2 * SE * PC / (SE + PC + 1e-6)
-
-    return F1
+    return compute_all(SR, GT, threshold)['F1']
 
 
 def get_JS(SR, GT, threshold=0.5):
     # JS : Jaccard similarity
-    SR = SR > threshold
-    GT = GT == paddle.max(GT)
-
-    Inter = paddle.sum((SR & GT))
-    Union = paddle.sum((SR | GT))
-
-    JS = float(Inter) / (float(Union) + 1e-6)
-
-    return JS
+    return compute_all(SR, GT, threshold)['JS']
 
 
 def get_DC(SR, GT, threshold=0.5):
     # DC : Dice Coefficient
-    SR = SR > threshold
-    GT = GT == paddle.max(GT)
-
-    Inter = paddle.sum((SR & GT))
-    DC = float(2 * Inter) / (float(paddle.sum(SR) + paddle.sum(GT)) + 1e-6)
-
-    return DC
-
-
+    return compute_all(SR, GT, threshold)['DC']
+
+
+class ConfusionMatrix:
+    # accumulates TP, FP, FN, TN over many batches on the device, the counts
+    # only go to the host when the metrics are computed
+
+    def __init__(self, threshold=0.5):
+        self.threshold = threshold
+        self.counts = None
+
+    def update(self, SR, GT, mask=None):
+        counts = confusion_counts(SR > self.threshold, GT > 0.5, mask)
+        self.counts = counts if self.counts is None else self.counts + counts
+
+    def compute(self):
+        TN, FN, FP, TP = [float(c) for c in self.counts.numpy()] if self.counts is not None else [0.] * 4
+
+        metrics = metrics_from_counts(TN, FN, FP, TP)
+        metrics.update({'precision': metrics['PC'], 'recall': metrics['SE'],
+                        'TP': TP, 'FP': FP, 'TN': TN, 'FN': FN})
+        return metrics
+
+
+class CurveAccumulator:
+    # streaming ROC / PR curves : predicted probabilities are counted into fixed
+    # bins, separately for positive and negative pixels, so memory is O(bins)
+    # whatever the number of images
+
+    def __init__(self, bins=1000):
+        self.bins = bins
+        self.counts = None
+
+    def update(self, SR, GT, mask=None):
+        # SR : probabilities in [0, 1], pixels outside the mask go to a dropped bin
+        idx = paddle.clip((SR * self.bins).astype('int64'), 0, self.bins - 1)
+        idx = idx * 2 + (GT > 0.5).astype('int64')
+        if mask is not None:
+            idx = paddle.where(mask > 0.5, idx, paddle.full_like(idx, 2 * self.bins))
+        counts = paddle.bincount(idx.flatten(), minlength=2 * self.bins + 1)[:2 * self.bins]
+        self.counts = counts if self.counts is None else self.counts + counts
+
+    def compute(self):
+        counts = self.counts.numpy().astype(np.float64).reshape([self.bins, 2])
+        neg, pos = counts[:, 0], counts[:, 1]
+
+        # sweep the threshold from high to low, entry i predicts positive for
+        # every probability >= thresholds[i]
+        thresholds = np.arange(self.bins - 1, -1, -1) / self.bins
+        TP = np.cumsum(pos[::-1])
+        FP = np.cumsum(neg[::-1])
+        P, N = TP[-1], FP[-1]
+
+        tpr = np.concatenate([[0.], TP / (P + 1e-6)])
+        fpr = np.concatenate([[0.], FP / (N + 1e-6)])
+        AUC_ROC = float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+
+        precision = TP / np.maximum(TP + FP, 1e-6)
+        recall = TP / (P + 1e-6)
+        # average precision : precision weighted by the recall gained at each threshold
+        AUC_PR = float(np.sum(np.diff(np.concatenate([[0.], recall])) * precision))
+
+        F1 = 2 * precision * recall / (precision + recall + 1e-6)
+        best = int(np.argmax(F1))
+
+        return {'AUC_ROC': AUC_ROC, 'AUC_PR': AUC_PR, 'best_F1': float(F1[best]),
+                'best_threshold': float(thresholds[best]), 'thresholds': thresholds,
+                'fpr': fpr[1:], 'tpr': tpr[1:], 'precision': precision, 'recall': recall}
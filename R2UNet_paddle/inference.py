@@ -0,0 +1,162 @@
+import os
+import paddle
+import paddle.inference
+import numpy as np
+from collections import deque
+
+
+class StaticPredictor:
+    '''
+    runs a program saved by model.export through paddle.inference with the IR
+    optimizations (and MKLDNN on CPU), called like the dygraph network
+    '''
+    def __init__(self, path_prefix, use_gpu=False, threads=None, int8=False):
+        # older paddle versions save .pdmodel, PIR saves .json
+        model_file = path_prefix + '.pdmodel'
+        if not os.path.exists(model_file):
+            model_file = path_prefix + '.json'
+        config = paddle.inference.Config(model_file, path_prefix + '.pdiparams')
+        if use_gpu:
+            config.enable_use_gpu(256, 0)
+        else:
+            config.disable_gpu()
+            config.enable_mkldnn()
+            if int8:
+                config.enable_mkldnn_int8()
+            if threads:
+                config.set_cpu_math_library_num_threads(threads)
+        config.switch_ir_optim(True)
+        config.disable_glog_info()
+
+        self.predictor = paddle.inference.create_predictor(config)
+        self.input = self.predictor.get_input_handle(self.predictor.get_input_names()[0])
+        # IterNet programs fetch every iteration, the last one is the prediction
+        self.output = self.predictor.get_output_handle(self.predictor.get_output_names()[-1])
+
+    def __call__(self, x):
+        if isinstance(x, paddle.Tensor):
+            x = x.numpy()
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        self.input.reshape(x.shape)
+        self.input.copy_from_cpu(x)
+        self.predictor.run()
+        return paddle.to_tensor(self.output.copy_to_cpu())
+
+
+def final_output(predict):
+    # IterNet returns the outputs of every iteration, only the last one is the prediction
+    if isinstance(predict, (list, tuple)):
+        return predict[-1]
+    return predict
+
+
+def prefetch(pool, fn, items, depth):
+    '''
+    run fn(*item) for every item on the executor pool, yielding the results in order
+    while keeping at most depth calls in flight ahead of the consumer
+    '''
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(fn, *item))
+        if len(pending) > depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def blend_window(tile_size, window='gaussian'):
+    '''
+    weights used to blend overlapping tiles, highest in the tile center where
+    the network sees the most context
+    '''
+    if window == 'gaussian':
+        coords = np.arange(tile_size) - (tile_size - 1) / 2
+        w = np.exp(-coords ** 2 / (2 * (tile_size / 8) ** 2))
+    elif window == 'linear':
+        w = 1 - np.abs(np.linspace(-1, 1, tile_size))
+    elif window == 'constant':
+        w = np.ones(tile_size)
+    else:
+        raise ValueError('unknown window: {}'.format(window))
+    w = np.outer(w, w)
+    # keep a small weight on the border so pixels covered by a single tile stay defined
+    return np.maximum(w / w.max(), 1e-3).astype(np.float32)
+
+
+def tile_starts(length, tile_size, stride):
+    starts = list(range(0, max(length - tile_size, 0) + 1, stride))
+    if starts[-1] + tile_size < length:
+        starts.append(length - tile_size)
+    return starts
+
+
+def pad_to_tile(img, tile_size):
+    # images smaller than a tile are zero padded at the bottom / right
+    _, h, w = img.shape
+    pad_h, pad_w = max(tile_size - h, 0), max(tile_size - w, 0)
+    if pad_h or pad_w:
+        img = np.pad(img, ((0, 0), (0, pad_h), (0, pad_w)), mode='constant')
+    return img
+
+
+def tile_coords(height, width, tile_size=256, overlap=64, multiple=16):
+    # top left corners of the overlapping tiles covering a (padded) image, multiple is
+    # the network's downsampling factor (2**depth)
+    if tile_size % multiple != 0:
+        raise ValueError('tile_size must be a multiple of {}, got {}'.format(multiple, tile_size))
+    if overlap >= tile_size:
+        raise ValueError('overlap must be smaller than tile_size')
+    stride = tile_size - overlap
+    return [(i, j) for i in tile_starts(height, tile_size, stride) for j in tile_starts(width, tile_size, stride)]
+
+
+def add_tiles(out, norm, predicts, coords, weight):
+    # accumulates tile predictions weighted by the blend window, the prediction is out / norm
+    tile_size = weight.shape[0]
+    for (i, j), p in zip(coords, predicts):
+        out[i:i + tile_size, j:j + tile_size] += p * weight
+        norm[i:i + tile_size, j:j + tile_size] += weight
+
+
+def predict_tiled(network, img, tile_size=256, overlap=64, batch_size=4, window='gaussian', mask=None, iterations=None,
+                  multiple=16):
+    '''
+    predict a full resolution image with overlapping tiles
+
+    img : C x H x W float array or tensor of any size, returns the H x W probability map.
+    memory is bounded by batch_size tiles regardless of the image size.
+    tile_size has to be a multiple of the network's downsampling, multiple (16 for four
+    2x downsamplings).
+    mask : optional 1 x H x W FOV mask, its tiles are passed to the network with the
+    image tiles (IterNet early exit). iterations : optional list, extended with the
+    IterNet iterations of every tile
+    '''
+    if isinstance(img, paddle.Tensor):
+        img = img.numpy()
+
+    _, h, w = img.shape
+    # the padding is cropped off again below
+    img = pad_to_tile(img, tile_size)
+    if mask is not None:
+        mask = pad_to_tile(mask, tile_size)
+    H, W = img.shape[1:]
+
+    weight = blend_window(tile_size, window)
+    out = np.zeros((H, W), dtype=np.float32)
+    norm = np.zeros((H, W), dtype=np.float32)
+
+    coords = tile_coords(H, W, tile_size, overlap, multiple)
+    with paddle.no_grad():
+        for k in range(0, len(coords), batch_size):
+            batch = coords[k:k + batch_size]
+            tiles = np.stack([img[:, i:i + tile_size, j:j + tile_size] for i, j in batch])
+            if mask is None:
+                predict = final_output(network(paddle.to_tensor(tiles)))
+            else:
+                masks = np.stack([mask[:, i:i + tile_size, j:j + tile_size] for i, j in batch])
+                predict = final_output(network(paddle.to_tensor(tiles), paddle.to_tensor(masks)))
+            if iterations is not None:
+                iterations.extend(network.last_iterations)
+            add_tiles(out, norm, predict.astype('float32').numpy()[:, 0], batch, weight)
+
+    return (out / norm)[:h, :w]
@@ -0,0 +1,79 @@
+import json
+import time
+import paddle
+
+
+class StepTimer:
+    '''
+    splits every training step into phases (data, forward, loss, backward, step) and
+    accumulates their wall time until the next summary. kernels run asynchronously on
+    the GPU, so without sync a phase may be charged to the one that waits for it
+    '''
+    def __init__(self, sync=False):
+        self.sync = sync and paddle.device.is_compiled_with_cuda()
+        self.totals = {}
+        self.steps = 0
+        self.samples = 0
+        self.window_start = time.perf_counter()
+        self.mark = self.window_start
+
+    def lap(self, phase):
+        # time since the previous lap is charged to phase and returned in seconds
+        if self.sync:
+            paddle.device.synchronize()
+        now = time.perf_counter()
+        elapsed = now - self.mark
+        self.totals[phase] = self.totals.get(phase, 0.) + elapsed
+        self.mark = now
+        return elapsed
+
+    def skip(self):
+        # restarts the clock without charging any phase, e.g. after validation
+        now = time.perf_counter()
+        self.window_start += now - self.mark
+        self.mark = now
+
+    def end_step(self, samples):
+        self.steps += 1
+        self.samples += samples
+
+    def summary(self):
+        # mean milliseconds per step of every phase and the samples per second
+        # since the last summary, then starts a new window
+        now = time.perf_counter()
+        steps = max(self.steps, 1)
+        result = {'{}_ms'.format(phase): total * 1000 / steps for phase, total in self.totals.items()}
+        result['samples_per_s'] = self.samples / max(now - self.window_start, 1e-9)
+        self.totals, self.steps, self.samples = {}, 0, 0
+        self.window_start = now
+        return result
+
+
+class ScalarWriter:
+    '''
+    writes scalars as JSON lines ({"step": ..., "tag": value, ...}) and / or to a
+    VisualDL log directory. visualdl is only imported when a directory is given
+    '''
+    def __init__(self, jsonl_path=None, visualdl_dir=None):
+        self.file = open(jsonl_path, 'a') if jsonl_path else None
+        self.visualdl = None
+        if visualdl_dir:
+            try:
+                from visualdl import LogWriter
+            except ImportError:
+                raise ImportError('--visualdl_dir needs visualdl: pip install visualdl')
+            self.visualdl = LogWriter(logdir=visualdl_dir)
+
+    def add_scalars(self, step, scalars):
+        if self.file is not None:
+            self.file.write(json.dumps(dict(step=step, time=time.time(), **scalars)) + '\n')
+            self.file.flush()
+        if self.visualdl is not None:
+            for tag, value in scalars.items():
+                self.visualdl.add_scalar(tag=tag, value=value, step=step)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        if self.visualdl is not None:
+            self.visualdl.close()
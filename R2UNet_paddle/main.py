@@ -1,20 +1,41 @@
 import paddle
 import paddle.nn as nn
 import paddle.optimizer as optim
-from model import R2UNet, UNet, IterNet
+import paddle.distributed as dist
+from model import R2UNet, UNet, IterNet, R2UNET_PRESETS, set_output_logits, set_recompute, set_iternet_inference, fuse_conv_bn, fusion_max_diff
+from inference import predict_tiled, final_output, prefetch, StaticPredictor
+import profiler
+import benchmark
+import segment
+import server
+import packed
+from instrumentation import StepTimer, ScalarWriter
+import checkpoint
+from profiler import count_flops
 from PIL import Image
-from sklearn.feature_extraction import image
 import os
+import math
+import itertools
+import collections
+import time
+import hashlib
+import json
+import resource
+import multiprocessing
+from queue import Empty
 import numpy as np
 import random
 from tqdm import tqdm
-from paddle.io import Dataset, DataLoader
+from paddle.io import Dataset, IterableDataset, DataLoader, get_worker_info
 from paddle.vision import transforms, datasets
+from paddle.static import InputSpec
 import paddle.nn.functional as F
 from evaluation import *
 import matplotlib.pyplot as plt
 from sklearn.metrics import roc_curve, auc
 import argparse
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 from reprod_log import ReprodLogger
 device = paddle.set_device('gpu') if paddle.device.is_compiled_with_cuda() else paddle.set_device('cpu')
 import warnings
@@ -37,91 +58,120 @@ trans_fn2 = transforms.Compose([
     transforms.ToTensor(),
 ])
 
-class UNetDataset(Dataset):
-    def __init__(self, root, transform=None):
-        self.root = root
-        self.transforms = transform
-        seed = random.randint(0, 2**32)
-        self.imgs_path = list(sorted(os.listdir(os.path.join(self.root,"images"))))
-        self.imgs = []
-        for path in self.imgs_path:
-            img_path = os.path.join(self.root, "images", path)
-            img = Image.open(img_path)
-            # image augmentation
-            random.seed(seed) 
-            img = self.transforms(img)
+def sample_patch_coords(height, width, patch_size, max_patches, random_state):
+    # same sampling as sklearn's extract_patches_2d, so every modality of an image
+    # gets identical patch locations for the same random_state
+    n_h = height - patch_size + 1
+    n_w = width - patch_size + 1
+    if max_patches >= n_h * n_w:
+        i_s, j_s = np.meshgrid(np.arange(n_h), np.arange(n_w), indexing='ij')
+        return i_s.flatten(), j_s.flatten()
+    rng = np.random.RandomState(random_state)
+    i_s = rng.randint(n_h, size=max_patches)
+    j_s = rng.randint(n_w, size=max_patches)
+    return i_s, j_s
 
-            # randomly select patches from 20 training images
-            img=paddle.transpose(img, perm=[1,2, 0])
-            img=paddle.to_tensor(image.extract_patches_2d(img, (48, 48), max_patches=1000, random_state = 1))
-            img=paddle.transpose(img, perm=[0,3,1,2])
 
-            for i, sub_img in enumerate(img):
-                self.imgs.append(sub_img)
-        
-        self.masks_path = list(sorted(os.listdir(os.path.join(self.root, "mask"))))
-        self.masks = []
-        for path in self.masks_path:
-            mask_path = os.path.join(self.root, "mask", path)
-            mask = Image.open(mask_path)
-            random.seed(seed)
-            mask = self.transforms(mask)
+def extract_patches(img, i_s, j_s, patch_size):
+    # img : H x W x C, returns N x C x patch_size x patch_size as a gather from a strided view
+    windows = np.lib.stride_tricks.sliding_window_view(img, (patch_size, patch_size), axis=(0, 1))
+    return windows[i_s, j_s]
 
-            # randomly select patches from 20 training images
-            mask = paddle.transpose(mask, perm=[1, 2, 0])
-            mask = paddle.to_tensor(image.extract_patches_2d(mask, (48, 48), max_patches=1000, random_state=1))
-            mask= mask.unsqueeze(3)
-            mask = paddle.transpose(mask, perm=[0,3,1,2])
-
-            for i, sub_mask in enumerate(mask):
-                self.masks.append(sub_mask)
-
-        self.targets_path = list(sorted(os.listdir(os.path.join(self.root, "1st_manual"))))
-        self.targets = []
-        for path in self.targets_path:
-            target_path = os.path.join(self.root, "1st_manual", path)
-            target = Image.open(target_path)
-            random.seed(seed)
-            target = self.transforms(target)
-
-            # randomly select patches from 20 training images
-            target = paddle.transpose(target, perm=[1, 2, 0])
-            target = paddle.to_tensor(image.extract_patches_2d(target, (48, 48), max_patches=1000, random_state=1))
-            target = target.unsqueeze(3)
-            target = paddle.transpose(target, perm=[0,3,1,2])
-
-            for i, sub_target in enumerate(target):
-                self.targets.append(sub_target)
 
+class UNetDataset(Dataset):
+    def __init__(self, root, transform=None, patch_size=48, max_patches=1000, random_state=1, cache_path=None):
+        # root : a DRIVE layout split directory, or a split of a packed file (see packed.open_split)
+        self.root = packed.FolderSplit(root) if isinstance(root, str) else root
+        self.transforms = transform
+        self.patch_size = patch_size
+        self.max_patches = max_patches
+        self.random_state = random_state
+
+        # patches are kept as one contiguous N x C x H x W uint8 array per modality.
+        # they only depend on the files and the sampling parameters, so they are
+        # extracted once and memory-mapped from disk on later epochs and runs
+        if cache_path is None:
+            self.imgs, self.masks, self.targets = self.extract_all()
+        else:
+            self.imgs, self.masks, self.targets = self.load_cache(cache_path)
+
+    def cache_key(self):
+        key = ['uint8', self.root.location, self.patch_size, self.max_patches, self.random_state]
+        for folder in packed.FOLDERS:
+            for k in range(len(self.root)):
+                key.append(self.root.stamp(folder, k))
+        return hashlib.md5(repr(key).encode()).hexdigest()
+
+    def load_cache(self, cache_path):
+        key = self.cache_key()
+        names = [os.path.join(cache_path, '{}_{}.npy'.format(key, m)) for m in ("imgs", "masks", "targets")]
+        if not all(os.path.exists(name) for name in names):
+            os.makedirs(cache_path, exist_ok=True)
+            coords = self.patch_coords()
+            for name, folder in zip(names, packed.FOLDERS):
+                # patches are written straight into the memory map, through a temporary
+                # file so an interrupted run never leaves a truncated cache
+                tmp_name = '{}.{}.tmp'.format(name, os.getpid())
+                self.extract(folder, coords, lambda shape: np.lib.format.open_memmap(
+                    tmp_name, mode='w+', dtype=np.uint8, shape=shape)).flush()
+                os.replace(tmp_name, name)
+
+        return [np.load(name, mmap_mode='r') for name in names]
+
+    def patch_coords(self):
+        # randomly select patches from the training images, the coordinates are
+        # shared by image, mask and target
+        coords = []
+        for k in range(len(self.root)):
+            width, height = self.root.size(k)
+            coords.append(sample_patch_coords(height, width, self.patch_size, self.max_patches, self.random_state))
+        return coords
+
+    def extract_all(self):
+        coords = self.patch_coords()
+        imgs = self.extract("images", coords)
+        masks = self.extract("mask", coords)
+        targets = self.extract("1st_manual", coords)
+
+        return imgs, masks, targets
+
+    def extract(self, folder, coords, alloc=np.empty):
+        n = sum(len(i_s) for i_s, _ in coords)
+        patches = None
+        start = 0
+        for k, (i_s, j_s) in enumerate(coords):
+            img = self.root.read(folder, k)
+            if img.ndim == 2:
+                img = img[..., np.newaxis]
+            if patches is None:
+                patches = alloc((n, img.shape[2], self.patch_size, self.patch_size))
+            patches[start:start + len(i_s)] = extract_patches(img, i_s, j_s, self.patch_size)
+            start += len(i_s)
+
+        return patches
 
     def __getitem__(self, idx):
-        
+        # idx may be an int or an array of indices, a batch is then a single gather
+        # from the patch arrays instead of a stack of per-patch tensors
+
         # seed so image and target have the same random tranform
         seed = random.randint(0, 2**32)
 
-        img = self.imgs[idx]
+        img = self.imgs[idx].astype(np.float32) / 255
         random.seed(seed)
-        # img = trans_fn2(img)
+        if self.transforms is not None:
+            img = self.transforms(img)
 
-        mask = self.masks[idx]
+        mask = self.masks[idx].astype(np.float32) / 255
         random.seed(seed)
-        # mask = trans_fn2(mask)
+        if self.transforms is not None:
+            mask = self.transforms(mask)
 
-        target = self.targets[idx]
+        target = self.targets[idx].astype(np.float32) / 255
         random.seed(seed)
-        # target = trans_fn2(target)
-
-        # fig = plt.figure()
-        # ax1 = fig.add_subplot(1,3,1)
-        # ax1.imshow(img.permute((1,2,0)))
-        # ax2 = fig.add_subplot(1,3,2)
-        # ax2.imshow(torch.squeeze(mask), cmap="gray")
-        # ax3 = fig.add_subplot(1,3,3)
-        # ax3.imshow(torch.squeeze(target), cmap="gray")
-        # plt.show()
-
+        if self.transforms is not None:
+            target = self.transforms(target)
 
-        # return img.to(device), mask.to(device), target.to(device)
         return img, mask, target
 
     def __len__(self):
@@ -129,190 +179,911 @@ class UNetDataset(Dataset):
         return len(self.imgs)
 
 
+class PatchBatchDataset(Dataset):
+    '''
+    map-style view of a UNetDataset where every item is a whole batch, read as one
+    gather from the uint8 patch arrays. batches cross the worker shared memory as
+    uint8 and are converted to float on the device (see to_input). with data parallel
+    training every rank takes an interleaved shard of the epoch's patch order, all
+    ranks need the same seed
+    '''
+    def __init__(self, dataset, batch_size, shuffle=False, seed=None, rank=0, world_size=1):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = random.randint(0, 2**32 - 1) if seed is None else seed
+        self.rank = rank
+        self.world_size = world_size
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch, start=0):
+        # start : batches of the epoch already trained (when resuming mid-epoch)
+        order = np.arange(len(self.dataset))
+        if self.shuffle:
+            order = np.random.RandomState([self.seed, epoch]).permutation(order)
+        # the tail is dropped so every rank runs the same number of steps
+        order = order[:len(order) // self.world_size * self.world_size][self.rank::self.world_size]
+        self.batches = [order[k:k + self.batch_size] for k in range(0, len(order), self.batch_size)][start:]
+
+    def __getitem__(self, idx):
+        # sorted indices keep the reads from the memory map sequential
+        indices = np.sort(self.batches[idx])
+        return self.dataset.imgs[indices], self.dataset.masks[indices], self.dataset.targets[indices]
+
+    def __len__(self):
+
+        return len(self.batches)
+
+
+def to_input(x):
+    # uint8 patches from PatchBatchDataset are scaled to [0, 1] after the transfer
+    if x.dtype == paddle.uint8:
+        return x.astype('float32') / 255
+    return x
+
+
+class RandomPatchDataset(IterableDataset):
+    '''
+    streams batches of random patches from the full-resolution images, only the images
+    themselves are kept in memory and every epoch samples new patch locations.
+    with data parallel training every rank takes an interleaved share of the patches.
+    the loader workers take whole batches in turn, so the loader yields exactly
+    len(self) batches in the order of the epoch plan. batches are uint8 (see to_input)
+    '''
+    def __init__(self, root, batch_size, patch_size=48, patches_per_image=1000, seed=None, rank=0, world_size=1):
+        # root : as for UNetDataset
+        self.root = packed.FolderSplit(root) if isinstance(root, str) else root
+        self.batch_size = batch_size
+        self.patch_size = patch_size
+        self.patches_per_image = patches_per_image
+        self.seed = random.randint(0, 2**32 - 1) if seed is None else seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        self.start = 0
+
+        self.imgs, self.masks, self.targets = [], [], []
+        for folder, store in zip(packed.FOLDERS, (self.imgs, self.masks, self.targets)):
+            for k in range(len(self.root)):
+                img = self.root.read(folder, k)
+                if img.ndim == 2:
+                    img = img[..., np.newaxis]
+                store.append(np.ascontiguousarray(img.transpose(2, 0, 1)))
+
+    def set_epoch(self, epoch, start=0):
+        # start : batches of the epoch already trained by this rank (when resuming mid-epoch)
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        # every worker of every rank draws the same epoch plan, the rank takes an interleaved
+        # share of the patches and the workers take turns over its batches
+        worker = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+        rng = np.random.RandomState([self.seed, self.epoch])
+
+        p = self.patch_size
+        img_ids = rng.permutation(np.repeat(np.arange(len(self.imgs)), self.patches_per_image))
+        heights = np.array([img.shape[1] for img in self.imgs])[img_ids]
+        widths = np.array([img.shape[2] for img in self.imgs])[img_ids]
+        i_s = (rng.random_sample(len(img_ids)) * (heights - p + 1)).astype(np.int64)
+        j_s = (rng.random_sample(len(img_ids)) * (widths - p + 1)).astype(np.int64)
+
+        patches = np.arange(self.rank, self.total(), self.world_size)
+        for b in range(self.start + worker_id, self.num_batches(), num_workers):
+            ks = patches[b * self.batch_size:(b + 1) * self.batch_size]
+            # image, mask and target are cut at the same location
+            yield tuple(np.stack([store[img_ids[k]][:, i_s[k]:i_s[k] + p, j_s[k]:j_s[k] + p] for k in ks])
+                        for store in (self.imgs, self.masks, self.targets))
+
+    def total(self):
+        # patches of the epoch, without the tail that not all ranks would get
+        n = len(self.imgs) * self.patches_per_image
+        return n // self.world_size * self.world_size
+
+    def num_batches(self):
+        # batches of the whole epoch on this rank
+        return math.ceil(self.total() // self.world_size / self.batch_size)
+
+    def __len__(self):
+
+        return self.num_batches() - self.start
+
+
+def segmentation_loss(predict, mask, target, logits=False):
+    # BCE inside the FOV mask, summed over the outputs of every IterNet iteration.
+    # the loss is always computed in float32
+    if not isinstance(predict, (list, tuple)):
+        predict = [predict]
+    mask = mask.reshape(shape=[mask.shape[0], -1])
+    target = target.reshape(shape=[target.shape[0], -1])
+
+    loss = 0
+    for iter_predict in predict:
+        iter_predict = iter_predict.reshape(shape=[iter_predict.shape[0], -1]).astype('float32')
+        if logits:
+            # masked pixels get zero weight, as the product with the mask does for probabilities
+            loss += F.binary_cross_entropy_with_logits(iter_predict, target, weight=mask)
+        else:
+            loss += F.binary_cross_entropy(iter_predict * mask, target)
+
+    return loss
+
+
+def image_metrics(predicts, masks, targets):
+    # F1, SE, SP, AC of every predicted H x W probability map inside its flattened FOV
+    # mask, targets are the 8 bit manual segmentations. images of the same size are
+    # counted together in one pass (see evaluation.compute_all)
+    if len(set(predict.shape for predict in predicts)) > 1:
+        return [image_metrics([p], [m], [t])[0] for p, m, t in zip(predicts, masks, targets)]
+    SR = paddle.to_tensor(np.stack(predicts).astype(np.float32))
+    GT = paddle.to_tensor(np.stack(targets).astype(np.float32) / 255)
+    FOV = paddle.to_tensor(np.stack([m.reshape(p.shape) for p, m in zip(predicts, masks)]).astype(np.float32))
+    metrics = compute_all(SR, GT, mask=FOV, per_sample=True)
+    return [tuple(float(v) for v in values) for values in zip(metrics['F1'], metrics['SE'], metrics['SP'], metrics['AC'])]
+
+
+def fov_mask(img, mask):
+    # the flattened test FOV mask as a 1 x H x W float array
+    return mask.reshape((1,) + img.shape[1:]).astype(np.float32)
+
+
+def build_network(name, config=None):
+    # config : width / depth / t / blocks of R2U-Net (see R2UNET_PRESETS)
+    if name == 'U-Net':
+        return UNet()
+    elif name == 'R2U-Net':
+        return R2UNet(**(config or {}))
+    elif name == 'IterNet':
+        return IterNet()
+    raise ValueError('unknown model: {}'.format(name))
+
+
+def network_config(args):
+    # the R2U-Net preset, with the sizes given on the command line taking precedence
+    config = dict(R2UNET_PRESETS[args.preset])
+    for key in ('width', 'depth', 't', 'blocks'):
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+    return config
+
+
+def size_multiple(name, config):
+    # input sizes have to be multiples of the network's downsampling factor
+    return 2 ** config['depth'] if name == 'R2U-Net' else 16
+
+
+def check_size(size, multiple, what):
+    if size % multiple != 0:
+        raise ValueError('{} ({}) is not a multiple of {}, the downsampling of the network (2**depth)'.format(what, size, multiple))
+
+
+def run_name(name, config):
+    # checkpoints of R2U-Net variants other than the paper's network are saved
+    # under a name carrying their configuration, e.g. R2U-Net-w32-d4-t1-b1
+    if name != 'R2U-Net' or config == R2UNET_PRESETS['base']:
+        return name
+    return '{}-w{width}-d{depth}-t{t}-b{blocks}'.format(name, **config)
+
+
+def peak_memory():
+    # peak bytes allocated on the GPU, or the peak resident set size of the process on CPU
+    if paddle.device.is_compiled_with_cuda():
+        return paddle.device.cuda.max_memory_allocated()
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def train_step_memory(name, config, level, shape, queue):
+    '''
+    peak memory of one forward / backward pass of network name on a random batch of
+    the given shape with recompute level, relative to the memory held before the step.
+    runs in its own process (see model.memory) so the CPU peak of one setting does
+    not hide the next
+    '''
+    network = build_network(name, config)
+    network.train()
+    set_recompute(network, level)
+    x = paddle.rand(shape)
+    target = (paddle.rand([shape[0], 1] + list(shape[2:])) > 0.9).astype('float32')
+    mask = paddle.ones_like(target)
+    if paddle.device.is_compiled_with_cuda():
+        paddle.device.cuda.reset_max_memory_allocated()
+    before = paddle.device.cuda.memory_allocated() if paddle.device.is_compiled_with_cuda() else peak_memory()
+
+    begin = time.perf_counter()
+    segmentation_loss(network(x), mask, target).backward()
+    queue.put((peak_memory() - before, time.perf_counter() - begin))
+
+
 class model:
 
     def __init__(self, args):
         
         self.model = args.model
+        self.config = network_config(args)
+        self.multiple = size_multiple(args.model, self.config)
+        # checkpoints and exported programs are saved as self.name
+        self.name = run_name(self.model, self.config)
         self.epoch = args.epoch
         self.lr = args.lr
         self.batch_s = args.batch_size
         self.data_path = args.dataset_path
         self.output = args.result_path
+        self.cache_path = args.cache_path
+        self.patch_sampling = args.patch_sampling
+        self.num_workers = args.num_workers
+        self.prefetch_factor = args.prefetch_factor
+        self.report_data_wait = args.report_data_wait
+        self.log_interval = args.log_interval
+        self.log_file = args.log_file
+        self.visualdl_dir = args.visualdl_dir
+        self.sync_timers = args.sync_timers
+        self.tile_size = args.tile_size
+        self.tile_overlap = args.tile_overlap
+        self.tile_batch = args.tile_batch
+        self.tile_window = args.tile_window
+        self.test_batch = args.test_batch
+        self.test_workers = args.test_workers
+        self.accum_steps = args.accum_steps
+        self.lr_scaling = args.lr_scaling
+        self.lr_base_batch = args.lr_base_batch
+        self.warmup_steps = args.warmup_steps
+        self.backend = args.backend
+        self.cpu_threads = args.cpu_threads
+        self.fuse_bn = args.fuse_bn
+        self.calib_batches = args.calib_batches
+        self.calib_batch_size = args.calib_batch_size
+        self.amp = args.amp
+        self.recompute = args.recompute
+        self.memory_size = args.memory_size
+        self.input_size = args.input_size
+        self.profile_out = args.profile_out
+        self.profile_repeat = args.profile_repeat
+        self.bench_models = args.bench_models
+        self.bench_modes = args.bench_modes
+        self.bench_batches = args.bench_batches
+        self.bench_sizes = args.bench_sizes
+        self.bench_warmup = args.bench_warmup
+        self.bench_iters = args.bench_iters
+        self.bench_out = args.bench_out
+        self.ckpt_dir = args.ckpt_dir or os.path.join(self.output, 'checkpoints', self.name)
+        self.ckpt_interval = args.ckpt_interval
+        self.ckpt_keep = args.ckpt_keep
+        self.resume = args.resume
+        self.exit_tol = args.exit_tol
+        self.exit_tols = args.exit_tols
+        self.segment_input = args.segment_input
+        self.segment_dir = args.segment_dir
+        self.threshold = args.threshold
+        self.decode_workers = args.decode_workers
+        self.write_workers = args.write_workers
+        self.queue_size = args.queue_size
+        self.host = args.host
+        self.port = args.port
+        self.max_batch = args.max_batch
+        self.max_wait_ms = args.max_wait_ms
+        self.load_image = args.load_image
+        self.concurrency = args.concurrency
+        self.load_requests = args.load_requests
+        self.sync_bn = args.sync_bn
+        # bfloat16 where float16 kernels are not available (CPU)
+        self.amp_dtype = args.amp_dtype or ('float16' if paddle.device.is_compiled_with_cuda() else 'bfloat16')
+
+        self.network = build_network(self.model, self.config)
 
-
-        if self.model == 'U-Net':
-            self.network = UNet()
-        elif self.model == 'R2U-Net':
-            self.network = R2UNet()
-        elif self.model == 'IterNet':
-            self.network = IterNet()
-            
     def train(self):
-        self.network.to(device)
+        # with data parallel training (see train_worker) every rank trains on its own shard
+        # of the patches, gradients are averaged across ranks. only rank 0 validates, logs
+        # and saves
+        self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+        check_size(48, self.multiple, 'the training patch size')
+        if self.world_size > 1 and self.sync_bn:
+            if paddle.device.is_compiled_with_cuda():
+                self.network = nn.SyncBatchNorm.convert_sync_batchnorm(self.network)
+            else:
+                print('--sync_bn needs GPUs, every rank keeps its own BatchNorm statistics')
+        self.network.to(paddle.get_device() if self.world_size > 1 else device)
         self.network.train()
 
-        optimizer = optim.Adam(learning_rate=self.lr, parameters=self.network.parameters())
-        scheduler = optim.lr.CosineAnnealingDecay(learning_rate=self.lr, T_max=self.epoch, eta_min=0.00001)
-        loss_fn = nn.BCELoss()
+        # with --amp the forward runs in float16/bfloat16, the networks return logits for
+        # binary_cross_entropy_with_logits and float16 losses are dynamically scaled
+        set_output_logits(self.network, self.amp)
+        scaler = paddle.amp.GradScaler(enable=self.amp and self.amp_dtype == 'float16', init_loss_scaling=2.**15)
+        # trade compute for memory : checkpointed blocks / stages are recomputed in backward
+        set_recompute(self.network, self.recompute)
+
+        # patches are extracted once (or loaded from the cache), the loaders reshuffle every epoch.
+        # with 'random' sampling the training patches are drawn from the full images on the fly
+        # worker processes pass batches through shared memory and keep prefetch_factor batches in flight
+        loader_args = dict(num_workers=self.num_workers, use_shared_memory=True,
+                           prefetch_factor=self.prefetch_factor, use_buffer_reader=True)
+        shard = dict(rank=self.rank, world_size=self.world_size)
+        if self.patch_sampling == 'random':
+            training_set = RandomPatchDataset(packed.open_split(self.data_path, 'training'), self.batch_s, **shard)
+            training_batches = training_set
+            training_loader = DataLoader(training_set, batch_size=None, **loader_args)
+        else:
+            # rank 0 fills the patch cache, the other ranks memory-map it
+            if self.world_size > 1 and self.rank != 0:
+                dist.barrier()
+            training_set = UNetDataset(packed.open_split(self.data_path, 'training'), cache_path=self.cache_path)
+            if self.world_size > 1 and self.rank == 0:
+                dist.barrier()
+            training_batches = PatchBatchDataset(training_set, self.batch_s, shuffle=True, **shard)
+            training_loader = DataLoader(training_batches, batch_size=None, **loader_args)
+        if self.world_size > 1:
+            # the shards only partition the patches when all ranks shuffle with the same seed
+            seed = paddle.to_tensor([training_batches.seed], dtype='int64')
+            dist.broadcast(seed, src=0)
+            training_batches.seed = int(seed)
+        if self.rank == 0:
+            validation_set = UNetDataset(packed.open_split(self.data_path, 'validation'), cache_path=self.cache_path)
+            validation_loader = DataLoader(PatchBatchDataset(validation_set, self.batch_s), batch_size=None, **loader_args)
+
+        # gradients of accum_steps batches are summed before every optimizer step. for large
+        # effective batches the learning rate is scaled from lr_base_batch and linearly warmed
+        # up before the cosine decay, which is stepped once per optimizer step
+        batches_per_epoch = len(training_batches)
+        steps_per_epoch = math.ceil(batches_per_epoch / self.accum_steps)
+        effective_batch = self.batch_s * self.accum_steps * self.world_size
+        lr = self.lr
+        if self.lr_scaling == 'linear':
+            lr = self.lr * effective_batch / self.lr_base_batch
+        elif self.lr_scaling == 'sqrt':
+            lr = self.lr * math.sqrt(effective_batch / self.lr_base_batch)
+        scheduler = optim.lr.CosineAnnealingDecay(learning_rate=lr, T_max=self.epoch * steps_per_epoch, eta_min=0.00001)
+        if self.warmup_steps > 0:
+            scheduler = optim.lr.LinearWarmup(scheduler, self.warmup_steps, start_lr=0., end_lr=lr)
+        optimizer = optim.Adam(learning_rate=scheduler, parameters=self.network.parameters())
+        if self.rank == 0:
+            print('effective batch size {}, learning rate {}, {} steps per epoch'.format(effective_batch, lr, steps_per_epoch))
+        # the gradients are all-reduced in backward, except for the batches accumulated before a step
+        network = paddle.DataParallel(self.network) if self.world_size > 1 else self.network
+
+        # every step is split into timed phases, every log_interval batches the window means,
+        # the loss, the learning rate and the patches per second are logged and written out
+        timer = StepTimer(sync=self.sync_timers)
+        writer = ScalarWriter(self.log_file, self.visualdl_dir) if self.rank == 0 else ScalarWriter()
+        global_step = 0
+        # the log window runs across epochs, window_batches are the batches summed in window_loss
+        window_loss, window_batches = 0, 0
+
+        # the full training state is checkpointed at the end of every epoch and every
+        # ckpt_interval optimizer steps. the writes run in a background thread from a host
+        # copy of the state, so training only waits for the copy
+        checkpointer = checkpoint.AsyncCheckpointer(self.ckpt_dir, keep=self.ckpt_keep) if self.rank == 0 else None
+        start_epoch, start_batch, start_loss = 0, 0, 0.
+        if self.resume:
+            path = self.resume
+            if path == 'latest':
+                found = checkpoint.checkpoints(self.ckpt_dir)
+                if not found:
+                    raise FileNotFoundError('no checkpoint to resume from in {}'.format(self.ckpt_dir))
+                path = found[-1]
+            state = checkpoint.load(path)
+            if state['name'] != self.name:
+                raise ValueError('checkpoint {} is of {}, not {}'.format(path, state['name'], self.name))
+            self.network.set_state_dict(state['network'])
+            optimizer.set_state_dict(state['optimizer'])
+            scheduler.set_state_dict(state['scheduler'])
+            if state['scaler']:
+                scaler.load_state_dict(state['scaler'])
+            checkpoint.set_rng_state(state['rng'])
+            # the same seed gives the same patch order, so the trained part of the epoch is skipped
+            training_batches.seed = state['data_seed']
+            start_epoch, start_batch, global_step = state['epoch'], state['batch'], state['global_step']
+            start_loss = float(state['sum_loss'])
+            print('resumed from {} at epoch {} batch {}'.format(path, start_epoch, start_batch))
+
+        def training_state(epoch, batch, sum_loss):
+            # epoch / batch : where training continues when resuming from this state
+            return {'name': self.name, 'network': self.network.state_dict(), 'optimizer': optimizer.state_dict(),
+                    'scheduler': scheduler.state_dict(), 'scaler': scaler.state_dict(), 'rng': checkpoint.rng_state(),
+                    'data_seed': training_batches.seed, 'epoch': epoch, 'batch': batch,
+                    'global_step': global_step, 'sum_loss': sum_loss}
+
+        for i in range(start_epoch, self.epoch):
+            if self.rank == 0:
+                print('{} epoch {} {}'.format('=' * 10, i, '=' * 10))
+            # the losses stay on the device, reading them every batch would wait for the step
+            sum_loss = start_loss
+            num_batches = start_batch
+            data_wait = []
+            # both datasets skip the batches of the epoch already trained (when resuming)
+            training_batches.set_epoch(i, start_batch)
+            start_batch, start_loss = 0, 0.
+            timer.skip()
+            optimizer.clear_grad()
+            for img, mask, target in tqdm(training_loader, total=batches_per_epoch, initial=num_batches, disable=self.rank != 0):
+                data_wait.append(timer.lap('data'))
+                img, mask, target = to_input(img), to_input(mask), to_input(target)
+                num_batches += 1
+                global_step += 1
+                # the last, possibly shorter, accumulation of the epoch is applied as well
+                step = num_batches % self.accum_steps == 0 or num_batches == batches_per_epoch
+                # batches summed into this step's gradient, fewer than accum_steps for that last one
+                group_start = (num_batches - 1) // self.accum_steps * self.accum_steps
+                accumulated = min(self.accum_steps, batches_per_epoch - group_start)
+
+                with network.no_sync() if self.world_size > 1 and not step else contextlib.nullcontext():
+                    with paddle.amp.auto_cast(enable=self.amp, dtype=self.amp_dtype):
+                        predict = network(img)
+                        timer.lap('forward')
+                        loss = segmentation_loss(predict, mask, target, logits=self.amp)
+                    timer.lap('loss')
+
+                    sum_loss += loss.detach()
+                    window_loss += loss.detach()
+                    window_batches += 1
+
+                    scaler.scale(loss / accumulated).backward()
+                timer.lap('backward')
+                if step:
+                    scaler.step(optimizer)
+                    scaler.update()
+                    optimizer.clear_grad()
+                    scheduler.step()
+                    # mid-epoch checkpoints are taken after an optimizer step, when no gradients are pending
+                    if self.rank == 0 and self.ckpt_interval > 0 and num_batches < batches_per_epoch \
+                            and scheduler.last_epoch % self.ckpt_interval == 0:
+                        checkpointer.save(training_state(i, num_batches, sum_loss), global_step)
+                timer.lap('step')
+                # patches/s of all ranks together
+                timer.end_step(img.shape[0] * self.world_size)
+
+                if self.rank == 0 and global_step % self.log_interval == 0:
+                    scalars = {'train/loss': float(window_loss) / window_batches, 'train/lr': optimizer.get_lr()}
+                    window_loss, window_batches = 0, 0
+                    scalars.update({'train/' + k: v for k, v in timer.summary().items()})
+                    tqdm.write('step {} loss {:.4f} lr {:.2e} | {:.1f} patches/s | '.format(
+                        global_step, scalars['train/loss'], scalars['train/lr'], scalars['train/samples_per_s'])
+                        + ' '.join('{} {:.1f}'.format(k[len('train/'):], v) for k, v in scalars.items() if k.endswith('_ms')))
+                    writer.add_scalars(global_step, scalars)
+
+            if self.rank != 0:
+                continue
+            if self.report_data_wait:
+                wait = np.array(data_wait)
+                print('data wait per step: mean {:.2f} ms, p95 {:.2f} ms, max {:.2f} ms, total {:.1f} s'.format(
+                    wait.mean() * 1000, np.percentile(wait, 95) * 1000, wait.max() * 1000, wait.sum()))
+
+            sum_loss = float(sum_loss) / max(num_batches, 1)
+            print('loss: {}'.format(sum_loss))
+            print('peak memory: {:.0f} MB (recompute: {})'.format(peak_memory() / 2**20, self.recompute))
 
-        for i in range(self.epoch):
-            print('{} epoch {} {}'.format('=' * 10, i, '=' * 10))
-            sum_loss = 0
-            training_set = UNetDataset(self.data_path+'training', trans_fn1)
-            validation_set = UNetDataset(self.data_path+'validation', trans_fn1)
-            training_loader = DataLoader(training_set, batch_size=self.batch_s, shuffle=True)
-            validation_loader = DataLoader(validation_set, batch_size=self.batch_s, shuffle=True)
-            for img, mask, target in tqdm(training_loader):
-                print("input:", img)
+            if i % 5 == 0:
+                paddle.save(self.network.state_dict(), '{}{}{}.pdparams'.format(self.output,self.name, i))
+
+            metrics, AUC = self.validate(validation_loader)
+            print(f'[Validation] F1:{metrics["F1"]:.4f}, Precision:{metrics["precision"]:.4f}, Recall:{metrics["recall"]:.4f}, AC: {metrics["AC"]:.4f}, AUC : {AUC:.4f}')
+            writer.add_scalars(global_step, {'epoch': i, 'train/epoch_loss': sum_loss, 'val/F1': metrics['F1'],
+                                             'val/precision': metrics['precision'], 'val/recall': metrics['recall'],
+                                             'val/AC': metrics['AC'], 'val/AUC': AUC})
+            checkpointer.save(training_state(i + 1, 0, 0.), global_step)
+        writer.close()
+        if self.rank == 0:
+            checkpointer.close()
+            paddle.save(self.network.state_dict(), '{}{}.pdparams'.format(self.output, self.name))
+
+    def validate(self, loader):
+        #Validation#
+        # confusion counts are accumulated on the device over the whole validation set
+        # (pixels outside the FOV mask are ignored) and the metrics come from the totals
+        confusion = ConfusionMatrix()
+        curves = CurveAccumulator()
+        self.network.eval()
+        with paddle.no_grad():
+            for img, mask, target in loader:
+                img, mask, target = to_input(img), to_input(mask), to_input(target)
+                with paddle.amp.auto_cast(enable=self.amp, dtype=self.amp_dtype):
+                    predict = final_output(self.network(img))
+                predict = predict.astype('float32')
+                if self.amp:
+                    predict = F.sigmoid(predict)
+
+                confusion.update(predict, target, mask)
+                curves.update(predict, target, mask)
+        self.network.train()
+        return confusion.compute(), curves.compute()['AUC_ROC']
 
-                predict = self.network(img)
+    
+    def inference_network(self, place='cpu'):
+        # load saved model, either as dygraph layers or as the exported static program
+        if self.backend != 'dygraph' and self.exit_tol > 0:
+            # the exported programs always run every IterNet iteration
+            raise ValueError('--exit_tol needs --backend dygraph, the {} backend runs all iterations'.format(self.backend))
+        if self.backend == 'predictor':
+            return StaticPredictor(self.export_prefix(), use_gpu='gpu' in str(place), threads=self.cpu_threads)
+        if self.backend == 'int8':
+            # the program saved by --mode quantize, on the MKLDNN int8 CPU kernels
+            return StaticPredictor(self.int8_prefix(), threads=self.cpu_threads, int8=True)
+        self.network.to(place)
+        self.network.load_dict(paddle.load('{}{}.pdparams'.format(self.output, self.name)))
+        self.network.eval()
+        network = self.network
+        if self.fuse_bn:
+            network = fuse_conv_bn(self.network)
+            print('conv-bn folding, max abs output difference: {:.2e}'.format(fusion_max_diff(self.network, network)))
+        # only the last IterNet output is used, with exit_tol easy images stop refining early
+        set_iternet_inference(network, exit_tol=self.exit_tol)
+        return network
 
-                print("predict:", predict)
+    def test(self, show):
+        '''
+        run test set
+        '''
+        if self.tile_size:
+            check_size(self.tile_size, self.multiple, '--tile_size')
+        else:
+            check_size(560, self.multiple, 'the test center crop')
+        network = self.inference_network()
+        # the FOV masks are passed to the IterNet early exit
+        early_exit = isinstance(network, IterNet) and self.exit_tol > 0
+        forward = lambda x, mask: network(paddle.to_tensor(x), paddle.to_tensor(mask)) if early_exit else network(paddle.to_tensor(x))
+        iterations = []
 
-                if self.model == 'IterNet':
-                    mask = mask.reshape(shape=[mask.size(0), -1])
-                    target = target.reshape(shape=[target.size(0), -1])
-                    loss = 0
-                    for j in range(3):
-                        iter_predict = predict[j].reshape(shape=[predict[j].size(0), -1])
-                        iter_predict = iter_predict * mask.reshape(shaep=[mask.size(0), -1])
+        # load test set
+        testing = packed.open_split(self.data_path, 'testing')
+        samples = [(testing, k) for k in range(len(testing))]
 
-                        loss += loss_fn(iter_predict, target)
+        # a thread pool decodes the next images while the current batch runs through the
+        # network, the metrics of a batch come from one confusion count (image_metrics).
+        # tiled prediction already batches the tiles of one image
+        batch_size = 1 if self.tile_size else self.test_batch
+        pool = ThreadPoolExecutor(max_workers=self.test_workers)
+        loaded = prefetch(pool, self.load_test_sample, samples, 2 * batch_size)
 
-                    sum_loss += loss
+        results = []
+        curves = CurveAccumulator()
+        with paddle.no_grad(), paddle.amp.auto_cast(enable=self.amp, dtype=self.amp_dtype):
+            while True:
+                batch = list(itertools.islice(loaded, batch_size))
+                if not batch:
+                    break
+
+                if self.tile_size:
+                    # with the early exit, every tile stops refining on its own part of the FOV
+                    predicts = [predict_tiled(network, img, self.tile_size, self.tile_overlap, self.tile_batch, self.tile_window,
+                                              fov_mask(img, mask) if early_exit else None, iterations if early_exit else None,
+                                              multiple=self.multiple)
+                                for img, mask, _, _ in batch]
+                elif len(set(img.shape for img, _, _, _ in batch)) == 1:
+                    predict = final_output(forward(np.stack([img for img, _, _, _ in batch]),
+                                                   np.stack([fov_mask(img, mask) for img, mask, _, _ in batch])))
+                    predicts = list(predict.astype('float32').numpy()[:, 0])
                 else:
-                    predict = predict.reshape(shape=[predict.shape[0], -1])
-                    predict = predict * mask.reshape(shape=[mask.shape[0], -1])
-                    target = target.reshape(shape=[target.shape[0], -1])
-
-
-                    loss = loss_fn(predict, target)
-                    sum_loss += loss.item()
+                    predicts = [final_output(forward(img[np.newaxis], fov_mask(img, mask)[np.newaxis])).astype('float32').numpy()[0, 0]
+                                for img, mask, _, _ in batch]
+                if early_exit and not self.tile_size:
+                    iterations.extend(network.last_iterations)
+
+                results.extend(image_metrics(predicts, [mask for _, mask, _, _ in batch], [target for _, _, target, _ in batch]))
+                for (img, mask, target, target_), predict in zip(batch, predicts):
+                    # ROC / PR curves are accumulated over the FOV pixels of the whole test set
+                    curves.update(paddle.to_tensor(predict.flatten()),
+                                  paddle.to_tensor(target.flatten() / 255), paddle.to_tensor(mask))
+
+                    # show predicted image
+                    if show:
+                        fig = plt.figure()
+                        ax1 = fig.add_subplot(1,3,1)
+                        ax1.imshow(img.transpose((1,2,0)))
+                        ax2 = fig.add_subplot(1,3,2)
+                        ax2.imshow(predict, cmap="gray")
+                        ax3 = fig.add_subplot(1,3,3)
+                        ax3.imshow(target, cmap="gray")
+                        plt.show()
+
+        pool.shutdown()
+
+        F1, SE, SP, AC = map(list, zip(*results))
+        curves = curves.compute()
 
-                optimizer.clear_grad()
-                loss.backward()
-                optimizer.step()
-
-            scheduler.step()
+        print('F1 score: %.4f' %(sum(F1)/len(F1)))
+        print('sensitivity: %.4f' %(sum(SE)/len(SE)))
+        print('specificity: %.4f' %(sum(SP)/len(SP)))
+        print('accuracy: %.4f' %(sum(AC)/len(AC)))
+        print('AUC: %.4f' %curves['AUC_ROC'])
+        print('AUC-PR: %.4f' %curves['AUC_PR'])
+        print('best F1: %.4f at threshold %.3f' %(curves['best_F1'], curves['best_threshold']))
+        if iterations:
+            print('IterNet iterations: %.2f of %d on average%s' %(np.mean(iterations), network.iter, ' (per tile)' if self.tile_size else ''))
 
-            sum_loss /= 230
-            print('loss: {}'.format(sum_loss))
+    def segment(self):
+        '''
+        segment every image of segment_input (a directory or a glob pattern) into a
+        probability map and a binarized mask in segment_dir. decoding, inference and
+        encoding / writing run as a pipeline : decode_workers threads read the next
+        images and write_workers threads write the finished ones while the network
+        runs, at most queue_size images wait between two stages. images whose outputs
+        already exist are skipped, so an interrupted run continues where it stopped
+        '''
+        paths = segment.input_paths(self.segment_input)
+        segment.check_unique(paths, self.segment_dir)
+        if self.tile_size:
+            check_size(self.tile_size, self.multiple, '--tile_size')
+        os.makedirs(self.segment_dir, exist_ok=True)
+        todo = [path for path in paths if not segment.done(path, self.segment_dir)]
+        print('{} images, {} already segmented'.format(len(paths), len(paths) - len(todo)))
+
+        network = self.inference_network(device)
+        # full images are padded to multiples of the downsampling, unless predicted by tiles
+        decode_pool = ThreadPoolExecutor(max_workers=self.decode_workers)
+        write_pool = ThreadPoolExecutor(max_workers=self.write_workers)
+        decoded = prefetch(decode_pool, segment.read_image, [(path,) for path in todo], self.queue_size)
+        written = collections.deque()
+        progress = tqdm(total=len(todo))
+
+        begin = time.perf_counter()
+        with paddle.no_grad(), paddle.amp.auto_cast(enable=self.amp, dtype=self.amp_dtype):
+            while True:
+                batch = list(itertools.islice(decoded, 1 if self.tile_size else self.test_batch))
+                if not batch:
+                    break
+
+                if self.tile_size:
+                    predicts = [predict_tiled(network, img, self.tile_size, self.tile_overlap, self.tile_batch,
+                                              self.tile_window, multiple=self.multiple) for _, img in batch]
+                elif len(set(img.shape for _, img in batch)) == 1:
+                    predict = final_output(network(paddle.to_tensor(np.stack([segment.pad_to_multiple(img, self.multiple) for _, img in batch]))))
+                    predicts = list(predict.astype('float32').numpy()[:, 0])
+                else:
+                    predicts = [final_output(network(paddle.to_tensor(segment.pad_to_multiple(img, self.multiple)[np.newaxis]))).astype('float32').numpy()[0, 0]
+                                for _, img in batch]
+
+                for (path, img), predict in zip(batch, predicts):
+                    predict = predict[:img.shape[1], :img.shape[2]]
+                    written.append(write_pool.submit(segment.write_outputs, path, predict, self.segment_dir, self.threshold))
+                # waits for the oldest writes, re-raising their errors
+                while len(written) > self.queue_size:
+                    written.popleft().result()
+                    progress.update()
+        while written:
+            written.popleft().result()
+            progress.update()
+        elapsed = time.perf_counter() - begin
+        progress.close()
+        decode_pool.shutdown()
+        write_pool.shutdown()
+        print('segmented {} images in {:.1f} s, {:.2f} images/s'.format(len(todo), elapsed, len(todo) / max(elapsed, 1e-9)))
+
+    def serve(self):
+        '''
+        HTTP inference service : the network is loaded and warmed up once, the tiles
+        of concurrent requests are fused into batches (see server.MicroBatcher)
+        '''
+        check_size(self.tile_size or 256, self.multiple, '--tile_size')
+        network = self.inference_network(device)
+        server.serve(network, self.host, self.port, self.tile_size or 256, self.tile_overlap, self.tile_window,
+                     self.max_batch, self.max_wait_ms, self.threshold, self.amp, self.amp_dtype, multiple=self.multiple)
+
+    def load_test(self):
+        # concurrent requests against a server started with --mode serve
+        if not self.load_image or not os.path.isfile(self.load_image):
+            raise ValueError('--mode load_test needs --load_image, an image file to post (got {})'.format(self.load_image))
+        result = server.load_test('http://{}:{}'.format(self.host, self.port), self.load_image,
+                                  self.concurrency, self.load_requests)
+        print(json.dumps(result, indent=1))
+
+    def exit_tradeoff(self):
+        '''
+        F1, AUC, latency and mean refinement iterations of IterNet on the test set
+        (center cropped to 560) for every early exit tolerance of exit_tols
+        '''
+        self.network.to('cpu')
+        self.network.load_dict(paddle.load('{}{}.pdparams'.format(self.output, self.name)))
+        self.network.eval()
+        if not isinstance(self.network, IterNet):
+            raise ValueError('--mode exit_tradeoff needs --model IterNet')
+
+        self.tile_size = 0
+        testing = packed.open_split(self.data_path, 'testing')
+        samples = [self.load_test_sample(testing, k) for k in range(len(testing))]
+
+        print('{:>10}{:>12}{:>8}{:>8}{:>14}'.format('exit_tol', 'iterations', 'F1', 'AUC', 'latency(ms)'))
+        for tol in [float(t) for t in self.exit_tols.split(',')]:
+            set_iternet_inference(self.network, exit_tol=tol)
+            F1, latency, iterations = [], [], []
+            curves = CurveAccumulator()
+            with paddle.no_grad():
+                for img, mask, target, target_ in samples:
+                    x, fov = paddle.to_tensor(img[np.newaxis]), paddle.to_tensor(fov_mask(img, mask)[np.newaxis])
+                    begin = time.perf_counter()
+                    predict = self.network(x, fov).numpy()[0, 0]
+                    latency.append(time.perf_counter() - begin)
+                    iterations.extend(self.network.last_iterations)
+                    F1.append(image_metrics([predict], [mask], [target])[0][0])
+                    curves.update(paddle.to_tensor(predict.flatten()),
+                                  paddle.to_tensor(target.flatten() / 255), paddle.to_tensor(mask))
+            print('{:>10g}{:>12.2f}{:>8.4f}{:>8.4f}{:>14.1f}'.format(
+                tol, np.mean(iterations), np.mean(F1), curves.compute()['AUC_ROC'], np.median(latency) * 1000))
+
+    def export_prefix(self):
+        return '{}{}_infer/model'.format(self.output, self.name)
+
+    def int8_prefix(self):
+        return '{}{}_int8/model'.format(self.output, self.name)
+
+    def export(self):
+        '''
+        export the trained network as a static program for paddle.inference,
+        batch size and image size stay dynamic
+        '''
+        self.network.to('cpu')
+        self.network.load_dict(paddle.load('{}{}.pdparams'.format(self.output, self.name)))
+        self.network.eval()
 
-            if i % 5 == 0:
-                paddle.save(self.network.state_dict(), '{}{}{}.pdparams'.format(self.output,self.model, i))
+        network = self.network
+        if self.fuse_bn:
+            network = fuse_conv_bn(self.network)
+            print('conv-bn folding, max abs output difference: {:.2e}'.format(fusion_max_diff(self.network, network)))
 
-            #Validation#
-            results=[]
-            self.network.eval()
-            with paddle.no_grad():
-                for i, (img, mask, target) in enumerate(validation_loader):
-                    predict = self.network(img)
-                    if self.model == 'IterNet':
-                        predict = predict[-1]
-
-                    predict = predict * mask
-                    predict = (predict>=0.5).astype(np.uint8)
-                    target = target * mask
-                    target = target.astype(np.uint8)
-                    predict = np.array(predict)
-                    target = np.array(target)
-                    TP = np.sum(np.logical_and(predict== 1, target == 1))  # true positive
-                    TN = np.sum(np.logical_and(predict== 0, target == 0))  # true negative
-                    FP = np.sum(np.logical_and(predict == 1, target == 0))  # false positive
-                    FN = np.sum(np.logical_and(predict == 0, target == 1))  # false negative
-                    AC = (TP + TN) / (TP + TN + FP + FN)  # accuracy
-                    SE = (TP) / (TP + FN)  # sensitivity
-                    SP = TN / (TN + FP)  # specificity
-                    precision = TP / (TP + FP)
-                    recall = TP / (TP + FN)
-                    F1 = 2 * ((precision * recall) / (precision + recall))
-                    fpr, tpr, _ = roc_curve(target.flatten(), predict.flatten())
-                    AUC = auc(fpr, tpr)
-                    results.append((F1, SE, SP, AC, AUC, precision, recall))
-                F1, SE, SP, AC, AUC, precision, recall= map(list, zip(*results))
-                print(f'[Validation] F1:{sum(F1)/len(F1):.4f}, Precision:{sum(precision)/len(precision):.4f}, Recall:{sum(recall)/len(recall):.4f}, AC: {sum(AC)/len(AC):.4f}, AUC : {sum(AUC)/len(AUC):.4f}')
-        paddle.save(self.network.state_dict(), '{}{}.pdparams'.format(self.output, self.model))
+        input_spec = [InputSpec(shape=[None, 3, None, None], dtype='float32', name='x')]
+        static_network = paddle.jit.to_static(network, input_spec=input_spec)
+        paddle.jit.save(static_network, self.export_prefix())
+        print('exported to {}'.format(self.export_prefix()))
 
-    
-    def test(self, show):
+    def quantize(self):
         '''
-        run test set
+        INT8 post-training quantization calibrated on training patches, compared
+        with FP32 on the validation patches
         '''
-        # load saved model
+        # only this mode needs paddle.quantization
+        import quantize
+
         self.network.to('cpu')
-        self.network.load_dict(paddle.load('{}{}.pdparams'.format(self.output, self.model)))
+        self.network.load_dict(paddle.load('{}{}.pdparams'.format(self.output, self.name)))
         self.network.eval()
+        network = fuse_conv_bn(self.network)
 
-        # load test set
-        self.imgs_path = list(sorted(os.listdir(self.data_path+'testing/images')))
-        self.masks_path = list(sorted(os.listdir(self.data_path + 'testing/mask')))
-        self.targets_path = list(sorted(os.listdir(self.data_path+'testing/1st_manual')))
-        
-        results = []
-        with paddle.no_grad():
-            for img_name, mask_name, target_name in zip(self.imgs_path, self.masks_path, self.targets_path):
-                img_path = os.path.join(self.data_path+'testing/images', img_name)
-                img = Image.open(img_path)
-                img = transforms.functional.center_crop(img, 560)
-                img = transforms.functional.to_tensor(img).unsqueeze(0)
-
-                mask_path = os.path.join(self.data_path+'testing/mask', mask_name)
-                mask = Image.open(mask_path)
-                mask = transforms.functional.center_crop(mask, 560)
-                mask = np.array(mask).flatten() / 255
-                mask = mask.astype(np.uint8)
-
-
-                target_path = os.path.join(self.data_path+'testing/1st_manual', target_name)
-                target = Image.open(target_path)
-                target = transforms.functional.center_crop(target, 560)
-                target = np.array(target)
-                target_ = target.flatten() / 255
-                target_ = target_.astype(np.uint8)
-                target_ = target_[mask==1]
-
-                predict = self.network(img)
-                if self.model == 'IterNet':
-                    predict = predict[-1]
-                predict = np.squeeze(predict.numpy(), axis=(0,1))
-                predict_ = predict.flatten()[mask==1]
-                predict_ = (predict_>=0.5).astype(np.uint8)
-
-
-                TP = np.sum(np.logical_and(predict_ == 1, target_ == 1)) # true positive
-                TN = np.sum(np.logical_and(predict_ == 0, target_ == 0)) # true negative
-                FP = np.sum(np.logical_and(predict_ == 1, target_ == 0)) # false positive
-                FN = np.sum(np.logical_and(predict_ == 0, target_ == 1)) # false negative
-
-                AC = (TP+TN)/(TP+TN+FP+FN) # accuracy
-                SE = (TP)/(TP+FN) # sensitivity
-                SP = TN/(TN+FP) # specificity
-                precision = TP/(TP+FP)
-                recall = TP/(TP+FN)
-                F1 = 2*((precision*recall)/(precision+recall))
-                fpr, tpr, _ = roc_curve(target_, predict_)
-                AUC = auc(fpr,tpr)
-                results.append((F1, SE, SP, AC, AUC))
-
-                # show predicted image
-                if show:
-                    fig = plt.figure()
-                    ax1 = fig.add_subplot(1,3,1)
-                    ax1.imshow(img.squeeze(0).permute((1,2,0)))
-                    ax2 = fig.add_subplot(1,3,2)
-                    ax2.imshow(predict, cmap="gray")
-                    ax3 = fig.add_subplot(1,3,3)
-                    ax3.imshow(target, cmap="gray")
-                    plt.show()
-
-        F1, SE, SP, AC, AUC = map(list, zip(*results))
+        calibration_set = UNetDataset(packed.open_split(self.data_path, 'training'), cache_path=self.cache_path)
+        evaluation_set = UNetDataset(packed.open_split(self.data_path, 'validation'), cache_path=self.cache_path)
+        prefix = self.int8_prefix()
+        results = quantize.compare(network, calibration_set, evaluation_set, prefix,
+                                   self.calib_batch_size, self.calib_batches, self.cpu_threads)
 
-        print('F1 score: %.4f' %(sum(F1)/len(F1)))
-        print('sensitivity: %.4f' %(sum(SE)/len(SE)))
-        print('specificity: %.4f' %(sum(SP)/len(SP)))
-        print('accuracy: %.4f' %(sum(AC)/len(AC)))
-        print('AUC: %.4f' %(sum(AUC)/len(AUC)))
+        print('saved INT8 program to {}'.format(prefix))
+        print('{:<18}{:>8}{:>8}{:>8}{:>8}{:>14}{:>12}'.format('', 'F1', 'SE', 'SP', 'AUC', 'latency(ms)', 'size(MB)'))
+        for name, r in results.items():
+            print('{:<18}{:>8.4f}{:>8.4f}{:>8.4f}{:>8.4f}{:>14.2f}{:>12.1f}'.format(
+                name, r['F1'], r['SE'], r['SP'], r['AUC'], r['latency_ms'], r['size_mb']))
+
+    def memory(self):
+        '''
+        peak training memory of one step on a batch_size x 3 x memory_size x memory_size
+        input, without recompute and with every recompute level. every level runs in its
+        own process, a level whose process dies (e.g. out of memory) is reported as failed
+        '''
+        check_size(self.memory_size, self.multiple, '--memory_size')
+        shape = [self.batch_s, 3, self.memory_size, self.memory_size]
+        print('peak memory of one training step, input {}'.format(shape))
+        print('{:<10}{:>14}{:>12}'.format('recompute', 'memory(MB)', 'time(s)'))
+        ctx = multiprocessing.get_context('spawn')
+        for level in ('none', 'block', 'stage'):
+            queue = ctx.Queue()
+            process = ctx.Process(target=train_step_memory, args=(self.model, self.config, level, shape, queue))
+            process.start()
+            result = None
+            while result is None and process.is_alive():
+                try:
+                    result = queue.get(timeout=1)
+                except Empty:
+                    pass
+            if result is None:
+                # the result may have been queued just before the process exited
+                try:
+                    result = queue.get(timeout=1)
+                except Empty:
+                    pass
+            process.join()
+            if result is None:
+                print('{:<10}{:>26}'.format(level, 'failed (exit code {})'.format(process.exitcode)))
+                continue
+            memory, seconds = result
+            print('{:<10}{:>14.0f}{:>12.2f}'.format(level, memory / 2**20, seconds))
+
+    def profile(self):
+        '''
+        per-layer and per-stage FLOPs, parameters, activation bytes and forward / backward
+        time of the network on a batch_size x 3 x input_size x input_size input
+        '''
+        check_size(self.input_size, self.multiple, '--input_size')
+        shape = [self.batch_s, 3, self.input_size, self.input_size]
+        records, total = profiler.profile(self.network, shape, self.profile_repeat)
+        stages = profiler.aggregate(self.network, records)
+
+        print('{} on input {}, {} threads'.format(self.name, shape, paddle.get_flags('FLAGS_paddle_num_threads')['FLAGS_paddle_num_threads']))
+        print('{:<14}{:>12}{:>12}{:>16}{:>14}{:>14}'.format('stage', 'GFLOPs', 'params(M)', 'activations(MB)', 'forward(ms)', 'backward(ms)'))
+        for stage in stages:
+            print('{:<14}{:>12.2f}{:>12.2f}{:>16.1f}{:>14.1f}{:>14.1f}'.format(
+                stage['stage'], stage['flops'] / 1e9, stage['params'] / 1e6, stage['activation_bytes'] / 2**20,
+                stage['forward_ms'], stage['backward_ms']))
+        print('{:<14}{:>12.2f}{:>12.2f}{:>16.1f}{:>14.1f}{:>14.1f}'.format(
+            'total', sum(s['flops'] for s in stages) / 1e9, sum(s['params'] for s in stages) / 1e6,
+            sum(s['activation_bytes'] for s in stages) / 2**20, total['forward_ms'], total['backward_ms']))
+
+        if self.profile_out:
+            info = {'model': self.name, 'config': self.config, 'shape': shape, 'repeat': self.profile_repeat,
+                    'paddle': paddle.__version__, 'device': str(device)}
+            profiler.export(self.profile_out, records, stages, total, info)
+            print('saved profile to {}'.format(self.profile_out))
+
+    def benchmark(self):
+        '''
+        latency percentiles and throughput of every benchmarked model, mode, batch size
+        and input size, saved as json for check_perf_diff.py
+        '''
+        results = benchmark.run(lambda name: build_network(name, self.config).to(device),
+                                self.bench_models.split(','), self.bench_modes.split(','),
+                                [int(b) for b in self.bench_batches.split(',')],
+                                [int(s) for s in self.bench_sizes.split(',')],
+                                self.bench_warmup, self.bench_iters)
+        with open(self.bench_out, 'w') as f:
+            json.dump(results, f, indent=1)
+        print('saved benchmark to {}'.format(self.bench_out))
+
+    def presets(self):
+        '''
+        parameters, FLOPs and CPU latency of one input_size x input_size image for every
+        R2U-Net preset, and the F1 on the validation patches of the presets trained
+        into result_path (train them with --preset <name>)
+        '''
+        size = self.input_size
+        for config in R2UNET_PRESETS.values():
+            check_size(size, size_multiple('R2U-Net', config), '--input_size')
+        validation_set = UNetDataset(packed.open_split(self.data_path, 'validation'), cache_path=self.cache_path)
+        print('{:<10}{:>20}{:>12}{:>12}{:>14}{:>8}'.format('preset', 'width/depth/t/blocks', 'params(M)', 'GFLOPs', 'latency(ms)', 'F1'))
+        for preset, config in R2UNET_PRESETS.items():
+            network = build_network('R2U-Net', config)
+            network.to('cpu')
+            network.eval()
+            params = sum(int(np.prod(p.shape)) for p in network.parameters())
+            flops = count_flops(network, [1, 3, size, size])
+
+            x = paddle.rand([1, 3, size, size])
+            latency = []
+            with paddle.no_grad():
+                for _ in range(4):
+                    begin = time.perf_counter()
+                    network(x)
+                    latency.append(time.perf_counter() - begin)
+
+            F1 = '-'
+            weights = '{}{}.pdparams'.format(self.output, run_name('R2U-Net', config))
+            if os.path.exists(weights):
+                network.load_dict(paddle.load(weights))
+                confusion = ConfusionMatrix()
+                with paddle.no_grad():
+                    for img, mask, target in DataLoader(PatchBatchDataset(validation_set, 64), batch_size=None):
+                        confusion.update(network(to_input(img)), to_input(target), to_input(mask))
+                F1 = '{:.4f}'.format(confusion.compute()['F1'])
+
+            print('{:<10}{:>20}{:>12.2f}{:>12.1f}{:>14.1f}{:>8}'.format(
+                preset, '{width}/{depth}/{t}/{blocks}'.format(**config), params / 1e6, flops / 1e9,
+                np.median(latency[1:]) * 1000, F1))
+
+    def load_test_sample(self, split, k):
+        # without tiling the images are center cropped to 560 and predicted in one pass,
+        # with tiling the full image is predicted tile by tile
+        crop = (lambda x: x) if self.tile_size else (lambda x: transforms.functional.center_crop(x, 560))
+
+        img = split.open('images', k)
+        img = crop(img)
+        img = transforms.functional.to_tensor(img).numpy()
+
+        mask = split.open('mask', k)
+        mask = crop(mask)
+        mask = np.array(mask).flatten() / 255
+        mask = mask.astype(np.uint8)
+
+        target = split.open('1st_manual', k)
+        target = crop(target)
+        target = np.array(target)
+        target_ = target.flatten() / 255
+        target_ = target_.astype(np.uint8)
+        target_ = target_[mask==1]
+
+        return img, mask, target, target_
 
     def save_model(self):
         self.network.to(device)
@@ -451,22 +1222,109 @@ class model:
         reprod_logger.save("../diff/bp_align_paddle.npy")
 
 
+def train_worker(args):
+    # one data parallel rank, started by --nprocs or by python -m paddle.distributed.launch.
+    # a single process trains as before
+    if dist.get_world_size() > 1:
+        dist.init_parallel_env()
+    model(args).train()
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='U-Net')
     # general setting
     parser.add_argument('--model', type=str, default='R2U-Net', help='U-Net R2U-Net IterNet')
-    parser.add_argument('--mode', type=str, default='train', help='train test')
-    parser.add_argument('--dataset_path', type=str, default='./DRIVE/', help='dataset path')
+    parser.add_argument('--mode', type=str, default='train', help='train test segment serve load_test pack export quantize memory presets profile benchmark exit_tradeoff')
+    parser.add_argument('--dataset_path', type=str, default='./DRIVE/', help='dataset path, a DRIVE layout directory or a file written by --mode pack')
+    parser.add_argument('--pack_path', type=str, default='./DRIVE.pack', help='packed dataset file written by --mode pack')
     parser.add_argument('--result_path', type=str, default='./', help='path to save output')
+    parser.add_argument('--preset', type=str, default='base', help='R2U-Net size: ' + ' '.join(R2UNET_PRESETS))
+    parser.add_argument('--width', type=int, default=None, help='R2U-Net channels of the first level (overrides the preset)')
+    parser.add_argument('--depth', type=int, default=None, help='R2U-Net downsamplings (overrides the preset)')
+    parser.add_argument('--t', type=int, default=None, help='R2U-Net recurrences per RC_block (overrides the preset)')
+    parser.add_argument('--blocks', type=int, default=None, help='R2U-Net RRC_blocks per level (overrides the preset)')
+    parser.add_argument('--input_size', type=int, default=560, help='image size of --mode presets / profile')
+    parser.add_argument('--profile_out', type=str, default=None, help='save the --mode profile results to a .json or .csv file')
+    parser.add_argument('--profile_repeat', type=int, default=3, help='profiled passes after the warmup pass')
+    parser.add_argument('--amp', action='store_true', help='train / test with automatic mixed precision')
+    parser.add_argument('--amp_dtype', type=str, default=None, help='float16 or bfloat16 (default: float16 on GPU, bfloat16 on CPU)')
+    parser.add_argument('--cache_path', type=str, default='./cache/', help='path to cache extracted patches')
     # training setting
     parser.add_argument('--epoch', type=int, default=45, help='training epoch')
     parser.add_argument('--lr', type=float, default=0.001, help='learning rate')
     parser.add_argument('--batch_size', type=int, default=1, help='batch size')
+    parser.add_argument('--accum_steps', type=int, default=1, help='batches whose gradients are accumulated per optimizer step')
+    parser.add_argument('--lr_scaling', type=str, default='none', help='scale lr with the effective batch size: none linear sqrt')
+    parser.add_argument('--lr_base_batch', type=int, default=1, help='effective batch size the given lr is tuned for')
+    parser.add_argument('--warmup_steps', type=int, default=0, help='optimizer steps of linear lr warmup before the cosine decay')
+    parser.add_argument('--num_workers', type=int, default=2, help='data loading worker processes (0 loads in the main process)')
+    parser.add_argument('--prefetch_factor', type=int, default=2, help='batches prefetched per worker')
+    parser.add_argument('--report_data_wait', action='store_true', help='report the time each step waits for data')
+    parser.add_argument('--recompute', type=str, default='none', help='activation recomputation: none block (every RRC_block) stage (every encoder / decoder stage)')
+    parser.add_argument('--memory_size', type=int, default=512, help='input size of the --mode memory training step')
+    parser.add_argument('--log_interval', type=int, default=50, help='batches between training logs')
+    parser.add_argument('--log_file', type=str, default=None, help='append the training scalars to this JSON lines file')
+    parser.add_argument('--visualdl_dir', type=str, default=None, help='also write the training scalars to this VisualDL log directory')
+    parser.add_argument('--sync_timers', action='store_true', help='synchronize the GPU between the timed phases of a step (exact but slower)')
+    parser.add_argument('--ckpt_dir', type=str, default=None, help='training state checkpoint directory (default: result_path/checkpoints/<model name>)')
+    parser.add_argument('--ckpt_interval', type=int, default=0, help='optimizer steps between mid-epoch checkpoints (0: only at the end of every epoch)')
+    parser.add_argument('--ckpt_keep', type=int, default=3, help='newest checkpoints kept (0: all)')
+    parser.add_argument('--resume', type=str, default=None, help='resume training from this checkpoint, or latest in --ckpt_dir')
+    parser.add_argument('--nprocs', type=int, default=1, help='data parallel training processes on this machine (gloo on CPU, NCCL on GPU)')
+    parser.add_argument('--sync_bn', action='store_true', help='synchronize BatchNorm statistics across data parallel ranks (GPU only)')
+    parser.add_argument('--patch_sampling', type=str, default='fixed', help='fixed (cached patches) or random (new patches every epoch)')
+    # benchmark setting
+    parser.add_argument('--bench_models', type=str, default='U-Net,R2U-Net,IterNet', help='comma separated models to benchmark')
+    parser.add_argument('--bench_modes', type=str, default='forward,backward,train', help='comma separated: forward backward train')
+    parser.add_argument('--bench_batches', type=str, default='1,4', help='comma separated batch sizes')
+    parser.add_argument('--bench_sizes', type=str, default='48,256,560,1024', help='comma separated input sizes')
+    parser.add_argument('--bench_warmup', type=int, default=3, help='untimed steps before every case')
+    parser.add_argument('--bench_iters', type=int, default=100, help='timed steps of every case, p99 needs at least 100')
+    parser.add_argument('--bench_out', type=str, default='./benchmark.json', help='benchmark results file')
+    # quantization setting
+    parser.add_argument('--calib_batches', type=int, default=32, help='training batches used to calibrate INT8 activation ranges')
+    parser.add_argument('--calib_batch_size', type=int, default=16, help='patches per calibration / evaluation batch')
+    # segmentation setting
+    parser.add_argument('--segment_input', type=str, default='./images/', help='directory or glob pattern of the images to segment')
+    parser.add_argument('--segment_dir', type=str, default='./segmentation/', help='directory of the probability maps and masks')
+    parser.add_argument('--threshold', type=float, default=0.5, help='probability threshold of the binarized masks')
+    parser.add_argument('--decode_workers', type=int, default=4, help='threads decoding the images to segment')
+    parser.add_argument('--write_workers', type=int, default=4, help='threads encoding and writing the outputs')
+    parser.add_argument('--queue_size', type=int, default=8, help='images waiting between two pipeline stages at most')
+    # serving setting
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='address of --mode serve')
+    parser.add_argument('--port', type=int, default=8866, help='port of --mode serve')
+    parser.add_argument('--max_batch', type=int, default=8, help='tiles fused into one forward pass at most')
+    parser.add_argument('--max_wait_ms', type=float, default=5, help='time a tile waits for a batch to fill at most')
+    parser.add_argument('--load_image', type=str, default=None, help='image posted by --mode load_test')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients of --mode load_test')
+    parser.add_argument('--load_requests', type=int, default=200, help='requests of --mode load_test')
     # testing setting
     parser.add_argument('--show', type=str, default='False', help='if show the predicted image')
+    parser.add_argument('--backend', type=str, default='dygraph', help='dygraph (.pdparams), predictor (program saved by --mode export) or int8 (program saved by --mode quantize)')
+    parser.add_argument('--cpu_threads', type=int, default=None, help='math library threads of the predictor backend')
+    parser.add_argument('--fuse_bn', action='store_true', help='fold BatchNorm into the preceding conv for test / export')
+    parser.add_argument('--test_batch', type=int, default=4, help='test images per forward pass')
+    parser.add_argument('--test_workers', type=int, default=4, help='threads decoding the next test images')
+    parser.add_argument('--exit_tol', type=float, default=0., help='IterNet stops refining an image once its mean change inside the FOV is below this (0: all iterations)')
+    parser.add_argument('--exit_tols', type=str, default='0,0.001,0.002,0.005,0.01', help='comma separated early exit tolerances of --mode exit_tradeoff')
+    parser.add_argument('--tile_size', type=int, default=0, help='predict full images with tiles of this size (multiple of 2**depth, 16 for U-Net / IterNet), 0 center crops to 560')
+    parser.add_argument('--tile_overlap', type=int, default=64, help='overlap between neighbouring tiles')
+    parser.add_argument('--tile_batch', type=int, default=4, help='tiles per forward pass')
+    parser.add_argument('--tile_window', type=str, default='gaussian', help='tile blending window: gaussian linear constant')
     args = parser.parse_args()
 
+    if args.mode == 'train':
+        if args.nprocs > 1:
+            # every process takes an equal share of the CPU cores unless set otherwise
+            os.environ.setdefault('OMP_NUM_THREADS', str(max(1, multiprocessing.cpu_count() // args.nprocs)))
+            dist.spawn(train_worker, args=(args,), nprocs=args.nprocs,
+                       backend='nccl' if paddle.device.is_compiled_with_cuda() else 'gloo')
+        else:
+            train_worker(args)
+        raise SystemExit
+
     m = model(args)
 
     ####################
@@ -474,16 +1332,37 @@ if __name__ == '__main__':
     # m.show_pkl()
     # m.forward_paddle()
     # m.loss_paddle()
-    m.metric_paddle()
+    # m.metric_paddle()
     # m.bp_align_paddle()
     #####################
 
-
-
-    # if args.mode == 'train':
-    #     m.train()
-    # else:
-    #     if args.show == 'True':
-    #         m.test(True)
-    #     else:
-    #         m.test(False)
\ No newline at end of file
+    if args.mode == 'serve':
+        m.serve()
+    elif args.mode == 'load_test':
+        m.load_test()
+    elif args.mode == 'pack':
+        # packs the DRIVE layout dataset_path into pack_path, then use --dataset_path pack_path
+        header = packed.pack(args.dataset_path, args.pack_path)
+        print('packed {} into {}'.format(', '.join('{} ({} samples)'.format(name, len(split['ids']))
+                                                   for name, split in header['splits'].items()), args.pack_path))
+    elif args.mode == 'segment':
+        m.segment()
+    elif args.mode == 'exit_tradeoff':
+        m.exit_tradeoff()
+    elif args.mode == 'export':
+        m.export()
+    elif args.mode == 'quantize':
+        m.quantize()
+    elif args.mode == 'memory':
+        m.memory()
+    elif args.mode == 'presets':
+        m.presets()
+    elif args.mode == 'profile':
+        m.profile()
+    elif args.mode == 'benchmark':
+        m.benchmark()
+    else:
+        if args.show == 'True':
+            m.test(True)
+        else:
+            m.test(False)
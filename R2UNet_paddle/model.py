@@ -1,5 +1,112 @@
+import copy
+import numpy as np
 import paddle
 import paddle.nn as nn
+from paddle.distributed.fleet.utils import recompute
+
+def set_output_logits(network, enable=True):
+    # switch the networks to return logits instead of probabilities,
+    # for a numerically safe BCE-with-logits loss under mixed precision
+    for layer in network.sublayers(include_self=True):
+        if hasattr(layer, 'output_logits'):
+            layer.output_logits = enable
+
+
+def set_recompute(network, level='none'):
+    # activation recomputation for training : 'block' checkpoints every RRC_block,
+    # 'stage' every encoder / decoder stage. only the inputs of a checkpointed part
+    # are kept in the forward pass, its inner activations (e.g. the t+1 recurrences
+    # of RC_block) are recomputed during backward
+    if level not in ('none', 'block', 'stage'):
+        raise ValueError('unknown recompute level: {}'.format(level))
+    for layer in network.sublayers(include_self=True):
+        if hasattr(layer, 'recompute_level'):
+            layer.recompute_level = level
+
+
+def set_iternet_inference(network, final_only=True, exit_tol=0.):
+    # IterNet inference (eval mode only) : final_only returns the last output alone and
+    # drops the earlier ones as it goes. exit_tol > 0 (implies final_only) stops refining
+    # an image once the mean absolute change of its output inside the FOV falls below
+    # exit_tol, the iterations every image used are kept in last_iterations
+    for layer in network.sublayers(include_self=True):
+        if isinstance(layer, IterNet):
+            layer.final_only = final_only
+            layer.exit_tol = exit_tol
+
+
+def recompute_layer(layer, *args):
+    '''
+    recompute(layer, *args) that updates the BatchNorm running statistics once per step.
+    recompute (reentrant, the default) runs layer without grad in the forward pass and again with grad during
+    backward, the second run normalizes with the same batch statistics but keeps the
+    running statistics (momentum 1)
+    '''
+    def run(*inputs):
+        if not paddle.is_grad_enabled():
+            return layer(*inputs)
+        norms = [l for l in layer.sublayers(include_self=True)
+                 if isinstance(l, (nn.BatchNorm1D, nn.BatchNorm2D, nn.BatchNorm3D, nn.SyncBatchNorm))]
+        momentums = [l._momentum for l in norms]
+        for l in norms:
+            l._momentum = 1.
+        try:
+            return layer(*inputs)
+        finally:
+            for l, momentum in zip(norms, momentums):
+                l._momentum = momentum
+    return recompute(run, *args)
+
+
+def run_stage(network, stage, *args):
+    # stage(*args), recomputed in backward when network checkpoints its stages.
+    # the first stage sees the input image only, which needs no gradient, and runs as usual
+    if network.recompute_level == 'stage' and network.training and any(not a.stop_gradient for a in args):
+        return recompute_layer(stage, *args)
+    return stage(*args)
+
+
+def fuse_conv_bn(network):
+    '''
+    returns an inference copy of network where every BatchNorm2D that directly follows
+    a Conv2D in a nn.Sequential is folded into the conv weight and bias and replaced
+    by an Identity. uses the running statistics, so only valid in eval mode
+    '''
+    fused = copy.deepcopy(network)
+    fused.eval()
+    with paddle.no_grad():
+        for layer in fused.sublayers(include_self=True):
+            if not isinstance(layer, nn.Sequential):
+                continue
+            names = list(layer._sub_layers.keys())
+            for conv_name, bn_name in zip(names[:-1], names[1:]):
+                conv, bn = layer._sub_layers[conv_name], layer._sub_layers[bn_name]
+                if not (isinstance(conv, nn.Conv2D) and isinstance(bn, nn.BatchNorm2D)):
+                    continue
+                # y = gamma * (conv(x) + b - mean) / sqrt(var + eps) + beta
+                scale = bn.weight / paddle.sqrt(bn._variance + bn._epsilon)
+                bias = conv.bias if conv.bias is not None else paddle.zeros_like(bn._mean)
+                weight = conv.weight * scale.reshape([-1, 1, 1, 1])
+                bias = (bias - bn._mean) * scale + bn.bias
+                if conv.bias is None:
+                    conv.bias = conv.create_parameter(shape=bias.shape, is_bias=True)
+                conv.weight.set_value(weight)
+                conv.bias.set_value(bias)
+                layer._sub_layers[bn_name] = nn.Identity()
+
+    return fused
+
+
+def fusion_max_diff(network, fused, shape=(1, 3, 64, 64)):
+    # parity check of fuse_conv_bn : largest absolute output difference on a random input
+    network.eval()
+    x = paddle.rand(shape)
+    with paddle.no_grad():
+        out, fused_out = network(x), fused(x)
+    if not isinstance(out, (list, tuple)):
+        out, fused_out = [out], [fused_out]
+    return max(float(paddle.abs(a - b).max()) for a, b in zip(out, fused_out))
+
 
 class RC_block(nn.Layer):
     def __init__(self,channel,t=2):
@@ -21,6 +128,9 @@ class RC_block(nn.Layer):
         return r_x
 
 class RRC_block(nn.Layer):
+    # see set_recompute
+    recompute_level = 'none'
+
     def __init__(self, channel, t=2):
         super().__init__()
 
@@ -31,108 +141,95 @@ class RRC_block(nn.Layer):
 
     def forward(self,x):
         
-        res_x = self.RC_net(x)
+        if self.recompute_level == 'block' and self.training:
+            res_x = recompute_layer(self.RC_net, x)
+        else:
+            res_x = self.RC_net(x)
 
         return x+res_x
 
+# configurations compared by main.py --mode presets
+R2UNET_PRESETS = {
+    'base': dict(width=64, depth=4, t=2, blocks=1),
+    'half': dict(width=32, depth=4, t=2, blocks=1),
+    't1': dict(width=64, depth=4, t=1, blocks=1),
+    'half-t1': dict(width=32, depth=4, t=1, blocks=1),
+    'small': dict(width=32, depth=3, t=1, blocks=1),
+}
+
+
 class R2UNet(nn.Layer):
-    def __init__(self):
+    # return the scores before the final sigmoid (see set_output_logits)
+    output_logits = False
+    # see set_recompute
+    recompute_level = 'none'
+
+    def __init__(self, width=64, depth=4, t=2, blocks=1):
+        '''
+        width : channels of the first level, doubled at every downsampling
+        depth : number of downsamplings (the inputs must be multiples of 2**depth)
+        t : recurrences of every RC_block
+        blocks : RRC_blocks per level
+        the defaults are the paper's network, whose parameter names they keep
+        '''
         super().__init__()
+        self.depth = depth
+        channels = [width * 2 ** k for k in range(depth + 1)]
 
-        self.conv1 = nn.Sequential(
-            nn.Conv2D(3, 64, 3, 1, 1),
-            nn.BatchNorm2D(64),
-            nn.ReLU(),
-            RRC_block(64),
-        )
+        def level(in_channel, channel):
+            layers = [nn.Conv2D(in_channel, channel, 3, 1, 1), nn.BatchNorm2D(channel), nn.ReLU()]
+            return layers + [RRC_block(channel, t=t) for _ in range(blocks)]
 
-        self.conv2 = nn.Sequential(
-            nn.MaxPool2D(2, stride=2),
-            nn.Conv2D(64, 128, 3, 1, 1),
-            nn.BatchNorm2D(128),
-            nn.ReLU(),
-            RRC_block(128),
-        )
-
-        self.conv3 = nn.Sequential(
-            nn.MaxPool2D(2, stride=2),
-            nn.Conv2D(128, 256, 3, 1, 1),
-            nn.BatchNorm2D(256),
-            nn.ReLU(),
-            RRC_block(256),
-        )
-
-        self.conv4 = nn.Sequential(
-            nn.MaxPool2D(2, stride=2),
-            nn.Conv2D(256, 512, 3, 1, 1),
-            nn.BatchNorm2D(512),
-            nn.ReLU(),
-            RRC_block(512),
-        )
+        # encoder : conv1 ... conv{depth}, every stage after the first downsamples
+        for k in range(depth):
+            pool = [nn.MaxPool2D(2, stride=2)] if k > 0 else []
+            in_channel = channels[k - 1] if k > 0 else 3
+            setattr(self, 'conv{}'.format(k + 1), nn.Sequential(*pool, *level(in_channel, channels[k])))
 
         self.trans_conv = nn.Sequential(
             nn.MaxPool2D(2, stride=2),
-            nn.Conv2D(512, 1024, 3, 1, 1),
-            nn.BatchNorm2D(1024),
-            nn.ReLU(),
-            RRC_block(1024),
-            nn.Conv2DTranspose(1024, 512, kernel_size=2, stride=2),
+            *level(channels[depth - 1], channels[depth]),
+            nn.Conv2DTranspose(channels[depth], channels[depth - 1], kernel_size=2, stride=2),
         )
 
-        self.up_conv1 = nn.Sequential(
-            nn.Conv2D(1024, 512, 3, 1, 1),
-            nn.BatchNorm2D(512),
-            nn.ReLU(),
-            RRC_block(512),
-            nn.Conv2DTranspose(512, 256, kernel_size=2, stride=2),
-        )
-
-        self.up_conv2 = nn.Sequential(
-            nn.Conv2D(512, 256, 3, 1, 1),
-            nn.BatchNorm2D(256),
-            nn.ReLU(),
-            RRC_block(256),
-            nn.Conv2DTranspose(256, 128, kernel_size=2, stride=2),
-        )
-
-        self.up_conv3 = nn.Sequential(
-            nn.Conv2D(256, 128, 3, 1, 1),
-            nn.BatchNorm2D(128),
-            nn.ReLU(),
-            RRC_block(128),
-            nn.Conv2DTranspose(128, 64, kernel_size=2, stride=2),
-        )
+        # decoder : up_conv1 ... up_conv{depth-1} take the concatenated skip connection
+        for k in range(1, depth):
+            channel = channels[depth - k]
+            setattr(self, 'up_conv{}'.format(k), nn.Sequential(
+                *level(2 * channel, channel),
+                nn.Conv2DTranspose(channel, channel // 2, kernel_size=2, stride=2),
+            ))
 
         self.final_conv = nn.Sequential(
-            nn.Conv2D(128, 64, 3, 1, 1),
-            nn.BatchNorm2D(64),
-            nn.ReLU(),
-            RRC_block(64),
-            nn.Conv2D(64, 1, 1),
+            *level(2 * width, width),
+            nn.Conv2D(width, 1, 1),
         )
 
         self.sigmoid = nn.Sigmoid()
 
     def forward(self, x):
 
-        x1 = self.conv1(x)
-        x2 = self.conv2(x1)
-        x3 = self.conv3(x2)
-        x4 = self.conv4(x3)
+        skips = []
+        for k in range(1, self.depth + 1):
+            x = run_stage(self, getattr(self, 'conv{}'.format(k)), x)
+            skips.append(x)
 
-        x = self.trans_conv(x4)
+        x = run_stage(self, self.trans_conv, x)
 
-        x = self.up_conv1(paddle.concat((x, x4), axis=1))
-        x = self.up_conv2(paddle.concat((x, x3), axis=1))
-        x = self.up_conv3(paddle.concat((x, x2), axis=1))
-        x = self.final_conv(paddle.concat((x, x1), axis=1))
+        for k in range(1, self.depth):
+            x = run_stage(self, getattr(self, 'up_conv{}'.format(k)), paddle.concat((x, skips[-k]), axis=1))
+        x = run_stage(self, self.final_conv, paddle.concat((x, skips[0]), axis=1))
 
-        x = self.sigmoid(x)
+        if not self.output_logits:
+            x = self.sigmoid(x)
         
         return x
 
 
 class UNet(nn.Layer):
+    output_logits = False
+    recompute_level = 'none'
+
     def __init__(self):
         super().__init__()
 
@@ -257,23 +354,27 @@ class UNet(nn.Layer):
 
     def forward(self, x):
 
-        x1 = self.conv1(x)
-        x2 = self.conv2(x1)
-        x3 = self.conv3(x2)
-        x4 = self.conv4(x3)
+        x1 = run_stage(self, self.conv1, x)
+        x2 = run_stage(self, self.conv2, x1)
+        x3 = run_stage(self, self.conv3, x2)
+        x4 = run_stage(self, self.conv4, x3)
 
-        x = self.trans_conv(x4)
+        x = run_stage(self, self.trans_conv, x4)
 
-        x = self.up_conv1(paddle.concat((x, x4), axis=1))
-        x = self.up_conv2(paddle.concat((x, x3), axis=1))
-        x = self.up_conv3(paddle.concat((x, x2), axis=1))
-        x = self.final_conv(paddle.concat((x, x1), axis=1))
+        x = run_stage(self, self.up_conv1, paddle.concat((x, x4), axis=1))
+        x = run_stage(self, self.up_conv2, paddle.concat((x, x3), axis=1))
+        x = run_stage(self, self.up_conv3, paddle.concat((x, x2), axis=1))
+        x = run_stage(self, self.final_conv, paddle.concat((x, x1), axis=1))
 
-        x = self.sigmoid(x)
+        if not self.output_logits:
+            x = self.sigmoid(x)
         
         return x
 
 class MainUNet(nn.Layer):
+    output_logits = False
+    recompute_level = 'none'
+
     def __init__(self):
         super().__init__()
 
@@ -370,22 +471,28 @@ class MainUNet(nn.Layer):
         self.conv_1x1 = nn.Conv2D(32, 1, 1)
     
     def forward(self, x):
-        latent1 = self.conv1(x)
-        x2 = self.conv2(latent1)
-        x3 = self.conv3(x2)
-        x4 = self.conv4(x3)
-        x = self.trans_conv(x4)
+        latent1 = run_stage(self, self.conv1, x)
+        x2 = run_stage(self, self.conv2, latent1)
+        x3 = run_stage(self, self.conv3, x2)
+        x4 = run_stage(self, self.conv4, x3)
+        x = run_stage(self, self.trans_conv, x4)
 
-        x = self.up_conv1(paddle.concat((x, x4), axis=1))
-        x = self.up_conv2(paddle.concat((x, x3), axis=1))
-        x = self.up_conv3(paddle.concat((x, x2), axis=1))
-        latent2 = self.up_conv4(paddle.concat((x, latent1), axis=1))
+        x = run_stage(self, self.up_conv1, paddle.concat((x, x4), axis=1))
+        x = run_stage(self, self.up_conv2, paddle.concat((x, x3), axis=1))
+        x = run_stage(self, self.up_conv3, paddle.concat((x, x2), axis=1))
+        latent2 = run_stage(self, self.up_conv4, paddle.concat((x, latent1), axis=1))
 
         x = self.conv_1x1(latent2)
 
-        return latent1, latent2, paddle.nn.functional.sigmoid(x)
+        if not self.output_logits:
+            x = paddle.nn.functional.sigmoid(x)
+
+        return latent1, latent2, x
 
 class MiniUNet(nn.Layer):
+    output_logits = False
+    recompute_level = 'none'
+
     def __init__(self, iter=2):
         super().__init__()
 
@@ -464,32 +571,44 @@ class MiniUNet(nn.Layer):
     def forward(self, latent1, latent2):
         latent3 = self.transpose(latent2)
         latent1 = paddle.concat((latent1, latent3), axis=1)
-        idx = int((latent1.size(1)-64)/32)
-        x1 = self.dim_reduc[idx](latent1)
-        x2 = self.conv1(x1)
-        x3 = self.conv2(x2)
-        x = self.trans_conv(x3)
+        idx = int((latent1.shape[1]-64)/32)
+        x1 = run_stage(self, self.dim_reduc[idx], latent1)
+        x2 = run_stage(self, self.conv1, x1)
+        x3 = run_stage(self, self.conv2, x2)
+        x = run_stage(self, self.trans_conv, x3)
 
-        x = self.up_conv1(paddle.concat((x, x3), axis=1))
-        x = self.up_conv2(paddle.concat((x, x2), axis=1))
-        latent2 = self.up_conv3(paddle.concat((x, x1), axis=1))
+        x = run_stage(self, self.up_conv1, paddle.concat((x, x3), axis=1))
+        x = run_stage(self, self.up_conv2, paddle.concat((x, x2), axis=1))
+        latent2 = run_stage(self, self.up_conv3, paddle.concat((x, x1), axis=1))
 
         x = self.conv_1x1(latent2)
 
-        return latent1, latent2, paddle.nn.functional.sigmoid(x)
+        if not self.output_logits:
+            x = paddle.nn.functional.sigmoid(x)
+
+        return latent1, latent2, x
 
 
         
 
 class IterNet(nn.Layer):
+    # see set_iternet_inference
+    final_only = False
+    exit_tol = 0.
+
     def __init__(self, t=2):
         super().__init__()
         self.iter = t
         
         self.main = MainUNet()
         self.mini = MiniUNet()
+        self.last_iterations = None
+
+    def forward(self, x, mask=None):
+        # mask : optional N x 1 x H x W FOV mask of the early exit
+        if not self.training and (self.final_only or self.exit_tol > 0):
+            return self.forward_final(x, mask)
 
-    def forward(self, x):
         out_list = []
         latent1, latent2, out = self.main(x)
         out_list.append(out)
@@ -499,4 +618,41 @@ class IterNet(nn.Layer):
             out_list.append(out)
 
         return out_list
-    
\ No newline at end of file
+
+    def forward_final(self, x, mask=None):
+        latent1, latent2, out = self.main(x)
+        iterations = np.zeros(x.shape[0], dtype=np.int64)
+        if self.exit_tol <= 0:
+            for _ in range(self.iter):
+                latent1, latent2, out = self.mini(latent1, latent2)
+            iterations[:] = self.iter
+            self.last_iterations = iterations
+            return out
+
+        # only the images still changing (active) run the next iteration, the latest
+        # output of every image is written into result
+        prob = paddle.nn.functional.sigmoid if self.mini.output_logits else (lambda o: o)
+        result = out
+        active = paddle.arange(x.shape[0])
+        fov = None if mask is None else mask.astype(out.dtype)
+        for _ in range(self.iter):
+            latent1, latent2, new = self.mini(latent1, latent2)
+            iterations[active.numpy()] += 1
+            result = paddle.scatter(result, active, new)
+
+            change = (prob(new) - prob(out)).abs()
+            if fov is None:
+                change = change.mean(axis=[1, 2, 3])
+            else:
+                change = (change * fov).sum(axis=[1, 2, 3]) / fov.sum(axis=[1, 2, 3]).clip(min=1)
+            keep = paddle.nonzero(change >= self.exit_tol).flatten()
+            if keep.shape[0] == 0:
+                break
+            if keep.shape[0] < active.shape[0]:
+                active, latent1, latent2, new = [paddle.gather(t, keep) for t in (active, latent1, latent2, new)]
+                if fov is not None:
+                    fov = paddle.gather(fov, keep)
+            out = new
+
+        self.last_iterations = iterations
+        return result
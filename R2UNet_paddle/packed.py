@@ -0,0 +1,200 @@
+import os
+import re
+import json
+import time
+import numpy as np
+from PIL import Image
+
+# images, FOV masks and manual segmentations of a DRIVE layout split
+FOLDERS = ("images", "mask", "1st_manual")
+MAGIC = b'R2UPACK1'
+# chunks start on page boundaries so every array maps without copying
+ALIGN = 4096
+
+
+class FolderSplit:
+    '''
+    a DRIVE layout split directory (images/, mask/, 1st_manual/). the files of the
+    three folders are matched by sample id, or by sorted position when the names
+    have no unique ids (see aligned_samples)
+    '''
+    def __init__(self, root):
+        self.root = root
+        self.location = os.path.abspath(root)
+        self.ids, self.names = aligned_samples(root, strict=False)
+
+    def __len__(self):
+        return len(self.names["images"])
+
+    def open(self, folder, k):
+        return Image.open(os.path.join(self.root, folder, self.names[folder][k]))
+
+    def read(self, folder, k):
+        return np.array(self.open(folder, k))
+
+    def size(self, k):
+        # width, height of image k, from the file header only
+        return self.open("images", k).size
+
+    def stamp(self, folder, k):
+        # changes whenever the file does (see UNetDataset.cache_key)
+        stat = os.stat(os.path.join(self.root, folder, self.names[folder][k]))
+        return folder, self.names[folder][k], stat.st_size, stat.st_mtime_ns
+
+
+class PackedSplit:
+    '''
+    one split of a packed dataset file, its arrays are read-only views of the memory map
+    '''
+    def __init__(self, path, name, data, header):
+        self.path = path
+        self.location = '{}:{}'.format(os.path.abspath(path), name)
+        self.data = data
+        self.ids = header['ids']
+        self.names = header['names']
+        self.arrays = header['arrays']
+        stat = os.stat(path)
+        self.file_stamp = (stat.st_size, stat.st_mtime_ns)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def read(self, folder, k):
+        chunk = self.arrays[folder][k]
+        size = int(np.prod(chunk['shape']))
+        return self.data[chunk['offset']:chunk['offset'] + size].reshape(chunk['shape'])
+
+    def open(self, folder, k):
+        return Image.fromarray(np.asarray(self.read(folder, k)))
+
+    def size(self, k):
+        height, width = self.arrays["images"][k]['shape'][:2]
+        return width, height
+
+    def stamp(self, folder, k):
+        return (folder, self.names[folder][k]) + self.file_stamp
+
+
+class PackedDataset:
+    '''
+    memory-mapped dataset file written by pack(). opening it only reads the JSON
+    header, the pixels are paged in when they are used
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('{} is not a packed dataset'.format(path))
+            length = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            self.header = json.loads(f.read(length).decode())
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        self.splits = {name: PackedSplit(path, name, self.data, split) for name, split in self.header['splits'].items()}
+
+    def __getitem__(self, name):
+        if name not in self.splits:
+            raise KeyError('{} has no split {}, only {}'.format(self.path, name, ', '.join(self.splits)))
+        return self.splits[name]
+
+
+def open_split(data_path, name):
+    # name split (training, validation, testing) of a DRIVE layout directory or a packed file
+    if os.path.isfile(data_path):
+        return PackedDataset(data_path)[name]
+    return FolderSplit(os.path.join(data_path, name))
+
+
+def sample_id(name):
+    # DRIVE names start with the sample number : 21_training.tif, 21_training_mask.gif, 21_manual1.gif
+    return re.match(r'^[^_.]+', name).group(0)
+
+
+def aligned_samples(root, strict=True):
+    '''
+    the file names of every sample of a split directory, matched by sample id
+    instead of listing position, raises ValueError when a folder lacks a sample.
+    ids are only unique for DRIVE style names, e.g. every CHASE_DB1 file
+    (Image_01L.jpg, Image_01L_1stHO.png) has the id Image. strict raises then,
+    otherwise the files are paired by sorted position, as long as the folders
+    hold the same number of files
+    '''
+    files = {}
+    for folder in FOLDERS:
+        files[folder] = {}
+        for name in sorted(os.listdir(os.path.join(root, folder))):
+            key = sample_id(name)
+            if key in files[folder]:
+                if not strict:
+                    return positional_samples(root)
+                raise ValueError('{}/{}: {} and {} have the same sample id'.format(root, folder, files[folder][key], name))
+            files[folder][key] = name
+    ids = sorted(files["images"])
+    for folder in FOLDERS[1:]:
+        if set(files[folder]) != set(ids):
+            missing = sorted(set(ids) ^ set(files[folder]))
+            raise ValueError('{}: images and {} do not match, samples {}'.format(root, folder, ', '.join(missing)))
+    return ids, {folder: [files[folder][key] for key in ids] for folder in FOLDERS}
+
+
+def positional_samples(root):
+    # the k-th sorted file of every folder, the ids are the image names without extension
+    names = {folder: sorted(os.listdir(os.path.join(root, folder))) for folder in FOLDERS}
+    counts = {folder: len(names[folder]) for folder in FOLDERS}
+    if len(set(counts.values())) != 1:
+        raise ValueError('{}: the folders hold different numbers of files, {}'.format(
+            root, ', '.join('{} {}'.format(folder, count) for folder, count in counts.items())))
+    return [os.path.splitext(name)[0] for name in names["images"]], names
+
+
+def pack(root, path):
+    '''
+    packs every DRIVE layout split directory of root (training, validation, testing, ...)
+    into the single file path : a header (magic, length, JSON index and metadata)
+    followed by the decoded uint8 arrays, each starting on a page boundary
+    '''
+    splits = [name for name in sorted(os.listdir(root))
+              if all(os.path.isdir(os.path.join(root, name, folder)) for folder in FOLDERS)]
+    if not splits:
+        raise ValueError('{} has no split directories with {}'.format(root, ', '.join(FOLDERS)))
+
+    header = {'version': 1, 'source': os.path.abspath(root), 'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'splits': {}}
+    arrays, chunks, relative = [], [], []
+    offset = 0
+    for split in splits:
+        ids, names = aligned_samples(os.path.join(root, split))
+        entry = {'ids': ids, 'names': names, 'arrays': {}}
+        for folder in FOLDERS:
+            entry['arrays'][folder] = []
+            for name in names[folder]:
+                array = np.ascontiguousarray(np.array(Image.open(os.path.join(root, split, folder, name))))
+                if array.dtype != np.uint8:
+                    # e.g. 1 bit masks would be packed as 0 / 1 instead of 0 / 255
+                    raise ValueError('{}: {} pixels, only 8 bit images can be packed'.format(
+                        os.path.join(root, split, folder, name), array.dtype))
+                entry['arrays'][folder].append({'offset': offset, 'shape': list(array.shape)})
+                arrays.append(array)
+                chunks.append(entry['arrays'][folder][-1])
+                relative.append(offset)
+                offset += -(-array.nbytes // ALIGN) * ALIGN
+        header['splits'][split] = entry
+
+    # the chunks follow the header, whose length depends on their offsets
+    start = 0
+    while True:
+        for chunk, rel in zip(chunks, relative):
+            chunk['offset'] = start + rel
+        encoded = json.dumps(header).encode()
+        end = len(MAGIC) + 8 + len(encoded)
+        if end <= start:
+            break
+        start = -(-end // ALIGN) * ALIGN
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.array([len(encoded)], dtype='<u8').tobytes())
+        f.write(encoded)
+        for array, chunk in zip(arrays, chunks):
+            f.seek(chunk['offset'])
+            f.write(array.tobytes())
+    os.replace(tmp_path, path)
+    return header
@@ -0,0 +1,45 @@
+# comparison of two results of main.py --mode benchmark. only needs the standard
+# library, so check_perf_diff.py runs without paddle
+
+
+def case_key(case):
+    return (case['model'], case['mode'], case['batch_size'], case['size'])
+
+
+def compare(base, new, tolerance=0.1, metric='p50_ms'):
+    '''
+    relative change of metric for the cases of two benchmark results. a case regresses
+    when it is more than tolerance slower than in base, when it failed in new, when it
+    has no reference in base (or the reference failed), when only one run has metric
+    and when it is missing from new. a metric neither run recorded (e.g. p99_ms below
+    100 iterations) is not a regression, the row says so
+    '''
+    base_cases = {case_key(c): c for c in base['results']}
+    new_keys = set()
+    rows = []
+    for case in new['results']:
+        key = case_key(case)
+        new_keys.add(key)
+        row = {'case': key, 'base': None, 'new': None, 'change': None, 'regression': True}
+        reference = base_cases.get(key)
+        if 'error' in case:
+            row['status'] = 'failed: {}'.format(case['error'])
+        elif reference is None:
+            row['status'] = 'no reference in base'
+        elif 'error' in reference:
+            row['status'] = 'reference failed: {}'.format(reference['error'])
+        elif case.get(metric) is None and reference.get(metric) is None:
+            row.update({'regression': False, 'status': 'no {} in either run'.format(metric)})
+        elif case.get(metric) is None or reference.get(metric) is None:
+            row['status'] = 'no {} in {}'.format(metric, 'new' if case.get(metric) is None else 'base')
+        else:
+            change = case[metric] / reference[metric] - 1
+            row.update({'base': reference[metric], 'new': case[metric], 'change': change,
+                        'regression': change > tolerance})
+            row['status'] = 'REGRESSION' if row['regression'] else 'ok'
+        rows.append(row)
+    for key in base_cases:
+        if key not in new_keys:
+            rows.append({'case': key, 'base': None, 'new': None, 'change': None, 'regression': True,
+                         'status': 'missing from new'})
+    return rows
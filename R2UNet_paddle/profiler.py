@@ -0,0 +1,187 @@
+import csv
+import json
+import time
+import paddle
+import paddle.nn as nn
+import numpy as np
+
+
+def conv_flops(layer, x, y):
+    # 2 * multiply-adds of a Conv2D / Conv2DTranspose call, x the input and y the output.
+    # a transposed conv does its multiply-adds per input pixel, a conv per output pixel
+    kernel = int(np.prod(layer.weight.shape[2:]))
+    if isinstance(layer, nn.Conv2DTranspose):
+        in_channel, out_channel = layer.weight.shape[0], layer.weight.shape[1] * layer._groups
+        pixels = int(np.prod(x.shape)) // x.shape[1]
+    else:
+        out_channel, in_channel = layer.weight.shape[0], layer.weight.shape[1] * layer._groups
+        pixels = int(np.prod(y.shape)) // y.shape[1]
+    return 2 * pixels * kernel * in_channel * out_channel // layer._groups
+
+
+def layer_flops(layer, x, y):
+    # FLOPs of one forward call of a leaf layer, element-wise layers count per output element
+    if isinstance(layer, (nn.Conv2D, nn.Conv2DTranspose)):
+        return conv_flops(layer, x, y)
+    numel = int(np.prod(y.shape))
+    if isinstance(layer, nn.BatchNorm2D):
+        # normalize, scale and shift
+        return 4 * numel
+    if isinstance(layer, nn.MaxPool2D):
+        return numel * int(np.prod(x.shape[2:])) // int(np.prod(y.shape[2:]))
+    if isinstance(layer, (nn.ReLU, nn.Sigmoid)):
+        return numel
+    return 0
+
+
+def count_flops(network, shape):
+    '''
+    FLOPs of the convolutions of one forward pass of network on a random input of
+    the given shape. forward hooks count every call, so a conv applied t+1 times
+    by RC_block is counted t+1 times
+    '''
+    total = [0]
+
+    def hook(layer, inputs, output):
+        total[0] += conv_flops(layer, inputs[0], output)
+
+    handles = [layer.register_forward_post_hook(hook) for layer in network.sublayers(include_self=True)
+               if isinstance(layer, (nn.Conv2D, nn.Conv2DTranspose))]
+    with paddle.no_grad():
+        network(paddle.rand(shape))
+    for handle in handles:
+        handle.remove()
+
+    return total[0]
+
+
+def synchronize():
+    if paddle.device.is_compiled_with_cuda():
+        paddle.device.synchronize()
+
+
+def profile(network, shape, repeat=3, backward=True):
+    '''
+    per-layer cost of network on a random input of the given shape : calls, FLOPs,
+    parameters, output activation bytes and forward / backward milliseconds of every
+    leaf layer, averaged over repeat passes after one warmup pass.
+
+    the hooks fire on every call, so RC_block's conv is counted t+1 times. the backward
+    time of a call runs from the gradient reaching its output to the next layer's
+    gradient, so the layer times add up to the backward pass
+    '''
+    leaves = [(name, layer) for name, layer in network.named_sublayers() if not layer.sublayers()]
+    records = {name: {'layer': name, 'type': type(layer).__name__, 'calls': 0, 'flops': 0,
+                      'params': sum(int(np.prod(p.shape)) for p in layer.parameters(include_sublayers=False)),
+                      'activation_bytes': 0, 'forward_ms': 0., 'backward_ms': 0.}
+               for name, layer in leaves}
+    state = {'record': False}
+    starts = {}
+    events = []
+
+    def on_output(record):
+        # the gradient reached the output of a call, its backward runs next
+        def hook(grad):
+            synchronize()
+            events.append((time.perf_counter(), record))
+        return hook
+
+    def make_hooks(name, layer):
+        record = records[name]
+
+        def pre_hook(layer, inputs):
+            synchronize()
+            starts[name] = time.perf_counter()
+
+        def post_hook(layer, inputs, output):
+            synchronize()
+            elapsed = time.perf_counter() - starts[name]
+            if not state['record']:
+                return
+            x = inputs[0]
+            record['calls'] += 1
+            record['forward_ms'] += elapsed * 1000
+            record['flops'] += layer_flops(layer, x, output)
+            record['activation_bytes'] += int(np.prod(output.shape)) * output.element_size()
+            if backward and not output.stop_gradient:
+                output.register_hook(on_output(record))
+
+        return [layer.register_forward_pre_hook(pre_hook), layer.register_forward_post_hook(post_hook)]
+
+    handles = [h for name, layer in leaves for h in make_hooks(name, layer)]
+    network.train() if backward else network.eval()
+    x = paddle.rand(shape)
+    total = {'forward_ms': 0., 'backward_ms': 0.}
+    for k in range(repeat + 1):
+        # the first pass is a warmup and is not recorded
+        state['record'] = k > 0
+        with paddle.set_grad_enabled(backward):
+            begin = time.perf_counter()
+            predict = network(x)
+            predict = predict if isinstance(predict, (list, tuple)) else [predict]
+            synchronize()
+            middle = time.perf_counter()
+            if backward:
+                events.clear()
+                sum(p.mean() for p in predict).backward()
+                synchronize()
+                events.append((time.perf_counter(), None))
+                network.clear_gradients()
+        if k > 0:
+            # the backward pass is split at the gradient events, every call gets the
+            # time until the next one (element-wise ops between layers included)
+            for (begin_event, record), (end_event, _) in zip(events[:-1], events[1:]):
+                record['backward_ms'] += (end_event - begin_event) * 1000
+            total['forward_ms'] += (middle - begin) * 1000
+            total['backward_ms'] += (time.perf_counter() - middle) * 1000
+    for handle in handles:
+        handle.remove()
+
+    records = list(records.values())
+    for record in records + [total]:
+        for key in ('calls', 'flops', 'activation_bytes', 'forward_ms', 'backward_ms'):
+            if key in record:
+                record[key] = record[key] / repeat
+    return records, total
+
+
+def stage_of(network, name, level=1):
+    # first level components of a layer name : conv1 ... trans_conv, up_conv*, final_conv.
+    # for IterNet the sub-networks are named after their class (MainUNet, MiniUNet)
+    parts = name.split('.')[:level]
+    layer = network
+    for k, part in enumerate(parts):
+        layer = getattr(layer, part)
+        if not isinstance(layer, (nn.Sequential, nn.LayerList)) and layer.sublayers():
+            parts[k] = type(layer).__name__
+    return '.'.join(parts)
+
+
+def aggregate(network, records, level=1):
+    # sums the layer records by stage, every record is tagged with its stage
+    stages = {}
+    for record in records:
+        record['stage'] = stage_of(network, record['layer'], level)
+        stage = stages.setdefault(record['stage'], {
+            'stage': record['stage'], 'flops': 0, 'params': 0,
+            'activation_bytes': 0, 'forward_ms': 0., 'backward_ms': 0.})
+        for key in ('flops', 'params', 'activation_bytes', 'forward_ms', 'backward_ms'):
+            stage[key] += record[key]
+    return list(stages.values())
+
+
+def export(path, records, stages, total, info=None):
+    '''
+    JSON with the layers, stages, totals and run info, or (for a .csv path) one
+    row per layer followed by one row per stage
+    '''
+    if path.endswith('.csv'):
+        fields = ['layer', 'type', 'stage', 'calls', 'flops', 'params', 'activation_bytes', 'forward_ms', 'backward_ms']
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields, restval='')
+            writer.writeheader()
+            writer.writerows(records)
+            writer.writerows(stages)
+    else:
+        with open(path, 'w') as f:
+            json.dump({'info': info or {}, 'total': total, 'stages': stages, 'layers': records}, f, indent=1)
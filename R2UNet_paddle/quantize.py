@@ -0,0 +1,99 @@
+import os
+import time
+import tempfile
+import paddle
+import numpy as np
+from paddle.static import InputSpec
+from paddle.quantization import PTQ, QuantConfig
+from paddle.quantization.observers import AbsmaxObserver
+from inference import StaticPredictor, final_output
+from evaluation import ConfusionMatrix, CurveAccumulator
+
+
+def calibrate(network, dataset, num_batches=32, batch_size=16, seed=0):
+    '''
+    post-training quantization : observes the activation ranges of network on
+    num_batches random batches of dataset patches and returns the converted
+    (quantize / dequantize) network. network should already have BatchNorm folded
+    '''
+    network.eval()
+    config = QuantConfig(activation=AbsmaxObserver(quant_bits=8), weight=AbsmaxObserver(quant_bits=8))
+    ptq = PTQ(config)
+    observed = ptq.quantize(network, inplace=False)
+
+    rng = np.random.RandomState(seed)
+    with paddle.no_grad():
+        for _ in range(num_batches):
+            indices = np.sort(rng.choice(len(dataset), size=min(batch_size, len(dataset)), replace=False))
+            img, _, _ = dataset[indices]
+            observed(paddle.to_tensor(img))
+
+    return ptq.convert(observed, inplace=False)
+
+
+def export(network, prefix):
+    # batch size and image size stay dynamic, so the program also predicts full images
+    input_spec = [InputSpec(shape=[None, 3, None, None], dtype='float32', name='x')]
+    paddle.jit.save(paddle.jit.to_static(network, input_spec=input_spec, full_graph=True), prefix)
+
+
+def params_size(prefix):
+    return os.path.getsize(prefix + '.pdiparams')
+
+
+def evaluate(predict_fn, dataset, batch_size):
+    '''
+    F1 / SE / SP / AUC over the patches of dataset and the latency of every forward pass
+    '''
+    confusion = ConfusionMatrix()
+    curves = CurveAccumulator()
+    latency = []
+    with paddle.no_grad():
+        for start in range(0, len(dataset), batch_size):
+            img, mask, target = dataset[np.arange(start, min(start + batch_size, len(dataset)))]
+            begin = time.perf_counter()
+            predict = final_output(predict_fn(paddle.to_tensor(img))).astype('float32')
+            latency.append(time.perf_counter() - begin)
+
+            mask, target = paddle.to_tensor(mask), paddle.to_tensor(target)
+            confusion.update(predict, target, mask)
+            curves.update(predict, target, mask)
+
+    metrics = confusion.compute()
+    latency = np.array(latency[1:] if len(latency) > 1 else latency)
+    return {'F1': metrics['F1'], 'SE': metrics['SE'], 'SP': metrics['SP'],
+            'AUC': curves.compute()['AUC_ROC'], 'latency_ms': float(np.median(latency) * 1000)}
+
+
+def compare(fp32_network, calibration_set, evaluation_set, prefix, batch_size=16, num_batches=32, threads=None):
+    '''
+    calibrates an INT8 version of fp32_network, saves it to prefix for paddle.inference
+    (MKLDNN int8 kernels on CPU) and reports accuracy, latency and size next to FP32.
+    the sizes are those of the saved .pdiparams files
+    '''
+    int8_network = calibrate(fp32_network, calibration_set, num_batches, batch_size)
+    export(int8_network, prefix)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        fp32_prefix = os.path.join(tmp, 'model')
+        export(fp32_network, fp32_prefix)
+        results['FP32'] = evaluate(StaticPredictor(fp32_prefix, threads=threads), evaluation_set, batch_size)
+        results['FP32']['size_mb'] = params_size(fp32_prefix) / 2**20
+
+    try:
+        name = 'INT8'
+        result = evaluate(StaticPredictor(prefix, threads=threads, int8=True), evaluation_set, batch_size)
+    except (RuntimeError, ValueError) as e:
+        # some paddle.inference builds cannot run the quantized program, the accuracy and
+        # latency are then those of the simulated (quantize / dequantize) dygraph network,
+        # which says nothing about the speed of real int8 kernels
+        reason = [line.strip() for line in str(e).splitlines() if 'Error' in line] or [str(e)]
+        print('paddle.inference could not run the INT8 program ({}), '
+              'reporting the simulated INT8 network instead'.format(reason[0]))
+        name = 'INT8 (simulated)'
+        result = evaluate(int8_network, evaluation_set, batch_size)
+    result['size_mb'] = params_size(prefix) / 2**20
+    results[name] = result
+
+    return results
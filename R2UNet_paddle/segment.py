@@ -0,0 +1,65 @@
+import os
+import glob
+import threading
+import numpy as np
+from PIL import Image
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.gif', '.bmp', '.ppm')
+
+
+def input_paths(pattern):
+    # every image of a directory, or the files matching a glob pattern, sorted
+    if os.path.isdir(pattern):
+        paths = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+        paths = [path for path in paths if path.lower().endswith(IMAGE_EXTENSIONS)]
+    else:
+        paths = glob.glob(pattern)
+    return sorted(paths)
+
+
+def output_paths(path, output_dir):
+    # probability map and binarized mask of the input image path
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(output_dir, name + '_prob.png'), os.path.join(output_dir, name + '_mask.png')
+
+
+def check_unique(paths, output_dir):
+    # inputs differing only by directory or extension (x/a.png, y/a.tif) would write the same outputs
+    owners = {}
+    for path in paths:
+        owners.setdefault(output_paths(path, output_dir)[0], []).append(path)
+    clashes = [inputs for inputs in owners.values() if len(inputs) > 1]
+    if clashes:
+        raise ValueError('inputs with the same output names in {} : {}'.format(
+            output_dir, '; '.join(', '.join(inputs) for inputs in clashes)))
+
+
+def done(path, output_dir):
+    # outputs are renamed into place once complete, so existing ones can be skipped
+    return all(os.path.exists(output) for output in output_paths(path, output_dir))
+
+
+def read_image(path):
+    # 3 x H x W float32 image in [0, 1]
+    img = np.asarray(Image.open(path).convert('RGB'), dtype=np.float32) / 255
+    return path, np.ascontiguousarray(img.transpose(2, 0, 1))
+
+
+def pad_to_multiple(img, multiple):
+    # zero pads the bottom / right of a C x H x W image to multiples of the network's downsampling
+    _, h, w = img.shape
+    pad_h, pad_w = -h % multiple, -w % multiple
+    if pad_h or pad_w:
+        img = np.pad(img, ((0, 0), (0, pad_h), (0, pad_w)), mode='constant')
+    return img
+
+
+def write_outputs(path, predict, output_dir, threshold=0.5):
+    # predict : H x W probability map, written as 8 bit PNGs through temporary files
+    prob = (np.clip(predict, 0, 1) * 255 + 0.5).astype(np.uint8)
+    mask = ((predict >= threshold) * 255).astype(np.uint8)
+    for output, array in zip(output_paths(path, output_dir), (prob, mask)):
+        tmp_output = '{}.{}.{}.tmp'.format(output, os.getpid(), threading.get_ident())
+        Image.fromarray(array).save(tmp_output, format='PNG')
+        os.replace(tmp_output, output)
+    return path
@@ -0,0 +1,294 @@
+import io
+import json
+import time
+import queue
+import threading
+import urllib.error
+import urllib.request
+import paddle
+import numpy as np
+from PIL import Image
+from collections import deque
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import Future, ThreadPoolExecutor
+from inference import final_output, blend_window, pad_to_tile, tile_coords, add_tiles
+
+# larger request bodies are refused (413) before being read
+MAX_BODY = 64 * 1024 * 1024
+
+
+class LatencyStats:
+    '''
+    latencies of the last window requests, summarized as percentiles in milliseconds
+    '''
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.count = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.count += 1
+
+    def error(self):
+        with self.lock:
+            self.errors += 1
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            result = {'requests': self.count, 'errors': self.errors}
+        if len(latencies):
+            result.update({'latency_ms_mean': float(latencies.mean()),
+                           **{'latency_ms_p{}'.format(q): float(np.percentile(latencies, q)) for q in (50, 95, 99)}})
+        return result
+
+
+class MicroBatcher:
+    '''
+    runs the tiles of concurrent requests through network in fused batches of at most
+    max_batch tiles. a batch starts as soon as it is full or its oldest tile has waited
+    max_wait_ms. the network only runs on the batcher thread
+    '''
+    def __init__(self, network, max_batch=8, max_wait_ms=5, amp=False, amp_dtype='float16'):
+        self.network = network
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.amp = amp
+        self.amp_dtype = amp_dtype
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.tiles = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, tiles):
+        # tiles : N x C x h x w array, returns a future per tile of its h x w probability map
+        futures = []
+        now = time.perf_counter()
+        for tile in tiles:
+            futures.append(Future())
+            self.queue.put((now, tile, futures[-1]))
+        return futures
+
+    def forward(self, tiles):
+        with paddle.no_grad(), paddle.amp.auto_cast(enable=self.amp, dtype=self.amp_dtype):
+            predict = final_output(self.network(paddle.to_tensor(tiles)))
+        return predict.astype('float32').numpy()[:, 0]
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = item[0] + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.queue.put(None)
+                    break
+                batch.append(item)
+
+            try:
+                predicts = self.forward(np.stack([tile for _, tile, _ in batch]))
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.tiles += len(batch)
+            for (_, _, future), predict in zip(batch, predicts):
+                future.set_result(predict)
+
+    def warmup(self, channels, tile_size, iters=2):
+        # the first passes of every batch size are slow (kernel selection, allocations)
+        for n in sorted({1, self.max_batch}):
+            for _ in range(iters):
+                for future in self.submit(np.zeros((n, channels, tile_size, tile_size), dtype=np.float32)):
+                    future.result()
+        self.batches, self.tiles = 0, 0
+
+    def summary(self):
+        return {'queue_depth': self.queue.qsize(), 'batches': self.batches,
+                'mean_batch_tiles': self.tiles / max(self.batches, 1)}
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class Segmenter:
+    '''
+    splits an image into overlapping tiles, has them predicted by the micro batcher
+    and blends the tile predictions back into a probability map
+    '''
+    def __init__(self, batcher, tile_size=256, overlap=64, window='gaussian', multiple=16):
+        self.batcher = batcher
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.multiple = multiple
+        self.weight = blend_window(tile_size, window)
+
+    def __call__(self, img):
+        # img : 3 x H x W float32 array in [0, 1], returns the H x W probability map
+        _, h, w = img.shape
+        img = pad_to_tile(img, self.tile_size)
+        H, W = img.shape[1:]
+        t = self.tile_size
+        coords = tile_coords(H, W, t, self.overlap, self.multiple)
+        futures = self.batcher.submit(np.stack([img[:, i:i + t, j:j + t] for i, j in coords]))
+        out = np.zeros((H, W), dtype=np.float32)
+        norm = np.zeros((H, W), dtype=np.float32)
+        add_tiles(out, norm, [future.result() for future in futures], coords, self.weight)
+        return (out / norm)[:h, :w]
+
+
+def decode(data):
+    img = np.asarray(Image.open(io.BytesIO(data)).convert('RGB'), dtype=np.float32) / 255
+    return np.ascontiguousarray(img.transpose(2, 0, 1))
+
+
+def encode(array):
+    buffer = io.BytesIO()
+    Image.fromarray(array).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def make_handler(segmenter, batcher, stats, threshold=0.5, max_body=MAX_BODY):
+    '''
+    POST /predict with an image file as the body returns the probability map as an 8 bit
+    PNG, /predict?output=mask the binarized mask. GET /metrics returns the request
+    latencies, queue depth and batch sizes as JSON, GET /health answers ok
+    '''
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def reply(self, code, body, content_type, close=False):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            if close:
+                # the unread request body would be parsed as the next request
+                self.send_header('Connection', 'close')
+                self.close_connection = True
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if path == '/metrics':
+                self.reply(200, json.dumps({**stats.summary(), **batcher.summary()}).encode(), 'application/json')
+            elif path == '/health':
+                self.reply(200, b'ok', 'text/plain')
+            else:
+                self.reply(404, b'not found', 'text/plain')
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/predict':
+                self.reply(404, b'not found', 'text/plain')
+                return
+            begin = time.perf_counter()
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+            except ValueError:
+                length = -1
+            if length < 0:
+                stats.error()
+                self.reply(400, b'invalid Content-Length', 'text/plain', close=True)
+                return
+            if length > max_body:
+                stats.error()
+                self.reply(413, 'request body larger than {} bytes'.format(max_body).encode(), 'text/plain', close=True)
+                return
+            try:
+                img = decode(self.rfile.read(length))
+            except Exception as e:
+                stats.error()
+                self.reply(400, 'cannot decode image: {}'.format(e).encode(), 'text/plain')
+                return
+            try:
+                predict = segmenter(img)
+            except Exception as e:
+                stats.error()
+                self.reply(500, str(e).encode(), 'text/plain')
+                return
+            if parse_qs(url.query).get('output', ['prob'])[0] == 'mask':
+                body = encode(((predict >= threshold) * 255).astype(np.uint8))
+            else:
+                body = encode((np.clip(predict, 0, 1) * 255 + 0.5).astype(np.uint8))
+            stats.add(time.perf_counter() - begin)
+            self.reply(200, body, 'image/png')
+
+        def log_message(self, format, *args):
+            # per-request logs would cost more than small requests themselves
+            pass
+
+    return Handler
+
+
+def serve(network, host='127.0.0.1', port=8866, tile_size=256, overlap=64, window='gaussian',
+          max_batch=8, max_wait_ms=5, threshold=0.5, amp=False, amp_dtype='float16', max_body=MAX_BODY, multiple=16):
+    # network is loaded (eval mode) by the caller, the server warms it up before listening.
+    # multiple : the network's downsampling factor, tile_size has to be a multiple of it
+    batcher = MicroBatcher(network, max_batch, max_wait_ms, amp, amp_dtype)
+    begin = time.perf_counter()
+    batcher.warmup(3, tile_size)
+    print('warmed up in {:.1f} s'.format(time.perf_counter() - begin))
+
+    segmenter = Segmenter(batcher, tile_size, overlap, window, multiple)
+    httpd = ThreadingHTTPServer((host, port), make_handler(segmenter, batcher, LatencyStats(), threshold, max_body))
+    httpd.daemon_threads = True
+    print('serving on http://{}:{} (POST /predict, GET /metrics)'.format(host, port))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        batcher.close()
+
+
+def load_test(url, image_path, concurrency=8, requests=100):
+    '''
+    posts image_path to a running server from concurrency threads, requests times in
+    total, and returns the client side latency percentiles (ms) of the successful requests,
+    the number of failed ones and the successful requests per second
+    '''
+    with open(image_path, 'rb') as f:
+        data = f.read()
+
+    def post(_):
+        begin = time.perf_counter()
+        request = urllib.request.Request(url.rstrip('/') + '/predict', data=data, method='POST')
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+        except (urllib.error.URLError, ConnectionError) as e:
+            # HTTPError is a URLError, one failed request does not end the test
+            return None, str(getattr(e, 'code', None) or getattr(e, 'reason', None) or e)
+        return time.perf_counter() - begin, None
+
+    begin = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(post, range(requests)))
+    elapsed = time.perf_counter() - begin
+    latencies = np.array([latency for latency, _ in results if latency is not None]) * 1000
+    errors = [error for _, error in results if error is not None]
+    result = {'requests': requests, 'concurrency': concurrency, 'errors': len(errors),
+              'requests_per_s': len(latencies) / elapsed}
+    if errors:
+        result['error_counts'] = {error: errors.count(error) for error in sorted(set(errors))}
+    if len(latencies):
+        result.update({'latency_ms_p{}'.format(q): float(np.percentile(latencies, q)) for q in (50, 95, 99)})
+    return result
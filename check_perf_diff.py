@@ -0,0 +1,47 @@
+import os
+import sys
+import json
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'R2UNet_paddle'))
+from perf_diff import compare
+
+if __name__ == "__main__":
+    # performance counterpart of check_log_diff.py : compares two results of
+    # main.py --mode benchmark and fails when a case got slower than the tolerance
+    parser = argparse.ArgumentParser(description='compare two benchmark results')
+    parser.add_argument('base', type=str, help='reference benchmark json')
+    parser.add_argument('new', type=str, help='benchmark json to check')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative slowdown')
+    parser.add_argument('--metric', type=str, default='p50_ms', help='p50_ms p95_ms mean_ms, or p99_ms when the runs had at least 100 --bench_iters')
+    parser.add_argument('--path', type=str, default=None, help='also write the report to this log file')
+    args = parser.parse_args()
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    lines = []
+    for key in ('paddle', 'device', 'paddle_num_threads', 'cpu_count'):
+        if base['environment'].get(key) != new['environment'].get(key):
+            lines.append('warning: {} differs ({} vs {})'.format(key, base['environment'].get(key), new['environment'].get(key)))
+
+    rows = compare(base, new, args.tolerance, args.metric)
+    if not any(row['change'] is not None for row in rows):
+        lines.append('warning: no case has {} in both runs, nothing was compared'.format(args.metric))
+    for row in rows:
+        if row['change'] is None:
+            lines.append('{:<8} {:<9} batch {:<3} size {:<5} {:>41} {}'.format(*row['case'], '', row['status']))
+        else:
+            lines.append('{:<8} {:<9} batch {:<3} size {:<5} {:10.2f} -> {:10.2f} ms {:+7.1%} {}'.format(
+                *row['case'], row['base'], row['new'], row['change'], row['status']))
+    regressions = sum(row['regression'] for row in rows)
+    lines.append('{} cases compared, {} regressions (slower than {:.0%} in {}, failed or unmatched)'.format(
+        len(rows), regressions, args.tolerance, args.metric))
+
+    print('\n'.join(lines))
+    if args.path:
+        with open(args.path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+    sys.exit(1 if regressions else 0)